@@ -0,0 +1,84 @@
+from io import BytesIO
+from array import array
+from sys import byteorder
+from subprocess import run as subprocess_run
+import wave
+
+
+def wav_read(content: bytes):
+    with wave.open(BytesIO(content)) as wav_file:
+        params = wav_file.getparams()
+        frames = wav_file.readframes(params.nframes)
+    return params, frames
+
+
+def wav_write(params, frames: bytes):
+    data = BytesIO()
+    with wave.open(data, 'wb') as wav_file:
+        wav_file.setparams(params)
+        wav_file.writeframes(frames)
+    return data.getvalue()
+
+
+# returns silent runs as (start window, end window), window is window_ms of audio
+def silences_find(samples, frame_rate, window_ms=10, threshold=500):
+    window = max(int(frame_rate * window_ms / 1000), 1)
+    silences = []
+    start = None
+    windows = (len(samples) + window - 1) // window
+    for index in range(windows):
+        chunk = samples[index * window: (index + 1) * window]
+        silent = max(chunk, default=0) < threshold and -min(chunk, default=0) < threshold
+        if silent and start is None:
+            start = index
+        elif not silent and start is not None:
+            silences.append((start, index))
+            start = None
+
+    if start is not None:
+        silences.append((start, windows))
+    return silences, window
+
+
+def wav_split(content: bytes, parts, min_silence_ms=500, window_ms=10, threshold=500):
+    """
+    splits wav (16 bit mono pcm) to parts by the longest silences between speech (breaks of batch ssml)
+    returns list of wav contents or None if there are less silences than needed
+    """
+    params, frames = wav_read(content)
+    if params.sampwidth != 2 or params.nchannels != 1:
+        raise Exception('only 16 bit mono wav can be split')
+
+    samples = array('h')
+    samples.frombytes(frames)
+    if byteorder == 'big':
+        samples.byteswap()
+
+    silences, window = silences_find(samples, params.framerate, window_ms=window_ms, threshold=threshold)
+    windows_total = (len(samples) + window - 1) // window
+    min_windows = min_silence_ms // window_ms
+    # silences at start and end are not between texts
+    silences = [silence for silence in silences
+                if silence[1] - silence[0] >= min_windows and silence[0] > 0 and silence[1] < windows_total]
+    if len(silences) < parts - 1:
+        return None
+
+    silences = sorted(silences, key=lambda silence: silence[1] - silence[0], reverse=True)[:parts - 1]
+    cuts = sorted((start + end) // 2 * window for start, end in silences)
+    bounds = [0] + cuts + [len(samples)]
+
+    sample_width = params.sampwidth
+    return [wav_write(params, frames[start * sample_width: end * sample_width])
+            for start, end in zip(bounds, bounds[1:])]
+
+
+# converts audio with ffmpeg (should be in PATH or set by app_path), f.e. wav clips to mp3 for anki cards
+def audio_convert(content: bytes, extension='mp3', app_path='ffmpeg'):
+    command = [app_path, '-loglevel', 'error', '-i', 'pipe:0', '-f', extension, 'pipe:1']
+    try:
+        result = subprocess_run(command, input=content, capture_output=True)
+    except FileNotFoundError:
+        raise Exception(f'failed to convert audio: {app_path} is not found (install ffmpeg)') from None
+    if result.returncode != 0:
+        raise Exception(f'failed to convert audio: {result.stderr.decode(errors="ignore")}')
+    return result.stdout
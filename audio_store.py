@@ -0,0 +1,98 @@
+from pathlib import Path
+from hashlib import sha256
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os import link as os_link
+from os import replace as os_replace
+from shutil import copyfile
+from threading import Lock
+
+
+def audio_key(text, voice, language, audio_format, params=None):
+    data = json_dumps({'text': text, 'voice': voice, 'language': language, 'format': audio_format,
+                       'params': params or {}}, sort_keys=True, ensure_ascii=False)
+    return sha256(data.encode('utf-8')).hexdigest()
+
+
+class AudioStore:
+    """
+    audio files named by hash of (text, voice, language, format, ssml params): <folder>/<key[:2]>/<key>.<extension>
+    index.jsonl (one line per file) is loaded once, so "is it already synthesized" is a dict lookup, not file stat
+    export_anki() creates names which anki cards need ("ATTS <text>.mp3") from stored files
+    """
+    def __init__(self, folder='audio_store', index_file='index.jsonl'):
+        self.folder = Path(folder)
+        self.index_file = self.folder.joinpath(index_file)
+        self.index = {}
+        self.lock = Lock()
+        self.index_load()
+
+    def index_load(self):
+        self.index = {}
+        if not self.index_file.exists():
+            return self.index
+
+        with self.index_file.open(encoding='utf-8') as index_data:
+            for line in index_data:
+                try:
+                    record = json_loads(line)
+                except ValueError:
+                    continue
+                self.index[record['key']] = record
+        return self.index
+
+    # rewrites index without duplicated lines
+    def index_compact(self):
+        with self.lock:
+            temp_file = self.index_file.with_suffix('.tmp')
+            data = ''.join(json_dumps(record, ensure_ascii=False) + '\n' for record in self.index.values())
+            temp_file.write_text(data, encoding='utf-8')
+            os_replace(temp_file, self.index_file)
+        return self.index_file
+
+    def has(self, key):
+        return key in self.index
+
+    def get(self, key):
+        record = self.index.get(key)
+        return self.folder.joinpath(record['file']) if record else None
+
+    def put(self, key, content: bytes, extension, **meta):
+        file = Path(key[:2], f'{key}.{extension}')
+        full_file = self.folder.joinpath(file)
+        full_file.parent.mkdir(parents=True, exist_ok=True)
+        full_file.write_bytes(content)
+
+        record = dict(meta, key=key, file=file.as_posix())
+        with self.lock:
+            self.index[key] = record
+            with self.index_file.open('a', encoding='utf-8') as index_data:
+                index_data.write(json_dumps(record, ensure_ascii=False) + '\n')
+        return full_file
+
+    def records_get(self, **meta):
+        return [record for record in self.index.values()
+                if all(record.get(field) == value for field, value in meta.items())]
+
+    # name_make - function which makes file name from text and extension (vocabulary_audio.anki_audio_name)
+    # texts - export only these texts, meta - filter records by meta (f.e. voice='es-ES-AlvaroNeural')
+    # files are hard linked (no copy of data), copied if it's not possible, existing files are skipped
+    def export_anki(self, folder, name_make, texts=None, **meta):
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        texts = set(texts) if texts is not None else None
+        exported = {}
+        for record in self.records_get(**meta):
+            text = record.get('text')
+            if not text or (texts is not None and text not in texts):
+                continue
+
+            source = self.folder.joinpath(record['file'])
+            target = folder.joinpath(name_make(text, source.suffix[1:]))
+            if not target.exists():
+                try:
+                    os_link(source, target)
+                except OSError:
+                    copyfile(source, target)
+            exported[text] = target
+        return exported
@@ -0,0 +1,295 @@
+"""
+benchmarks of vocabulary pipeline against local stand-ins of GPT, TTS and SpanishDict (see stub_servers)
+every case is measured by: words/sec, p50/p95 of chunk (request) latency, memory peak, file i/o counts
+
+    python benchmarks.py                          # sizes 1000 10000, all cases
+    python benchmarks.py --sizes 1000 10000 100000 --latency 0.5
+    python benchmarks.py --sizes 100000 --cases add_new_words csv_export
+    python benchmarks.py --compare benchmarks/results/a.json benchmarks/results/b.json
+
+results are saved to benchmarks/results/<date>-<git commit>.json
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+from json import dumps as json_dumps
+from json import loads as json_loads
+from time import perf_counter
+from datetime import datetime
+from threading import Lock
+from tempfile import TemporaryDirectory
+from subprocess import run as subprocess_run
+from statistics import quantiles
+import sys
+import tracemalloc
+import stub_servers
+import gpt_helper
+import spanish_dict
+import vocabulary_audio
+from rate_limiter import RateLimiter
+from metrics import metrics
+from service_speach import MSSpeach
+from words_formatter import Vocabulary, create_vocabulary
+
+cases_all = ('create_vocabulary', 'add_new_words', 'add_new_words_async', 'merge_vocabularies', 'anki_tags_add',
+             'csv_export', 'load_vocabulary', 'spanish_dict_lists', 'audio_generate')
+results_folder = Path('benchmarks', 'results')
+
+
+class TimedBackend(gpt_helper.ChatBackend):
+    # keeps latency of every request of backend
+    def __init__(self, backend: gpt_helper.ChatBackend):
+        self.backend = backend
+        self.model = backend.model
+        self.latencies = []
+        self.lock = Lock()
+
+    def send(self, messages: list, on_delta=None):
+        start = perf_counter()
+        result = self.backend.send(messages, on_delta=on_delta)
+        with self.lock:
+            self.latencies.append(perf_counter() - start)
+        return result
+
+    async def async_send(self, messages: list, on_delta=None):
+        start = perf_counter()
+        result = await self.backend.async_send(messages, on_delta=on_delta)
+        with self.lock:
+            self.latencies.append(perf_counter() - start)
+        return result
+
+
+class IOCounter:
+    # counts file operations with audit hooks (hook can't be removed, so it counts only while active)
+    events = {'open': 'opens', 'os.scandir': 'listdirs', 'os.listdir': 'listdirs', 'os.rename': 'renames',
+              'os.replace': 'renames', 'os.remove': 'removes'}
+
+    def __init__(self):
+        self.active = False
+        self.counts = {}
+        sys.addaudithook(self.hook)
+
+    def hook(self, event, args):
+        if self.active and event in self.events:
+            if event == 'open' and not isinstance(args[0], (str, Path)):
+                return
+            name = self.events[event]
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def start(self):
+        self.counts = {name: 0 for name in self.events.values()}
+        self.active = True
+
+    def stop(self):
+        self.active = False
+        return dict(self.counts)
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    if len(values) == 1:
+        return round(values[0], 4)
+    return round(quantiles(values, n=100, method='inclusive')[percent - 1], 4)
+
+
+def words_make(size):
+    return [f'palabra {index}' for index in range(size)]
+
+
+def entries_make(size, source='bench, bench', offset=0):
+    return [stub_servers.ChatStubHandler.word_make({'id': index + 1, 'word': f'palabra {index + offset}'}) | {
+                'source': source} for index in range(size)]
+
+
+def vocabulary_make(folder, size=0, offset=0):
+    vocabulary = Vocabulary('spanish', 'russian', 'bench', 'bench', folder=str(folder), threads_workers=20)
+    if size:
+        vocabulary.set_words_modified(entries_make(size, offset=offset))
+    return vocabulary
+
+
+def case_create_vocabulary(size, folder, env):
+    create_vocabulary(words_make(size), 'spanish', 'russian', 'bench', 'bench', folder=str(folder), create_new=True)
+
+
+def case_add_new_words(size, folder, env):
+    vocabulary_make(folder).add_new_words(words_make(size))
+
+
+def case_add_new_words_async(size, folder, env):
+    vocabulary_make(folder).add_new_words(words_make(size), use_async=True)
+
+
+def case_merge_vocabularies(size, folder, env):
+    # half of words are in both vocabularies, second one is saved, so merge removes its file
+    first = vocabulary_make(folder, size)
+    second = vocabulary_make(folder, size, offset=size // 2)
+    second.write_to_file(overwrite=False)
+    env['start']()
+    first.merge_vocabularies(second)
+
+
+def case_anki_tags_add(size, folder, env):
+    file = vocabulary_make(folder, size).write_to_file()
+    env['start']()
+    Vocabulary.anki_tags_add(file, return_rows=False)
+
+
+def case_csv_export(size, folder, env):
+    vocabulary = vocabulary_make(folder, size)
+    env['start']()
+    vocabulary.words_export_to_csv(vocabulary.words_modified)
+
+
+# memory peak shows size of loaded words (WordEntry records)
+def case_load_vocabulary(size, folder, env):
+    file = vocabulary_make(folder, size).write_to_file()
+    env['start']()
+    Vocabulary.load_vocabulary(file)
+
+
+def case_spanish_dict_lists(size, folder, env):
+    stub_servers.SpanishDictStubHandler.lists = {1: ('Bench', 'bench', size)}
+    spanish_dict.vocabs_index.clear()
+    spanish_dict.cache_folder = folder.joinpath('spanish_dict_cache')
+    spanish_dict.vocab_content_by_name('Bench')
+
+
+def case_audio_generate(size, folder, env):
+    vocabulary = vocabulary_make(folder, size)
+    env['start']()
+    vocabulary_audio.audio_generate(vocabulary, env['speach'], folder=folder.joinpath('audio'), fields=('whole_word',),
+                                    max_workers=20)
+
+
+def case_run(case, size, env):
+    with TemporaryDirectory() as folder:
+        folder = Path(folder)
+        timed_backend = env['backend']
+        timed_backend.latencies = []
+        io_counter = env['io_counter']
+        marks = {}
+
+        # cases which prepare data call start() to exclude preparation from measurement
+        def start():
+            tracemalloc.reset_peak()
+            metrics.reset()
+            io_counter.start()
+            marks['start'] = perf_counter()
+
+        env['start'] = start
+        tracemalloc.start()
+        start()
+        globals()[f'case_{case}'](size, folder, env)
+        duration = perf_counter() - marks['start']
+        io_counts = io_counter.stop()
+        memory_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stages = metrics.summary()
+
+    return {
+                'case': case,
+                'size': size,
+                'seconds': round(duration, 4),
+                'words_per_sec': round(size / duration, 1) if duration else None,
+                'requests': len(timed_backend.latencies),
+                'latency_p50': percentile(timed_backend.latencies, 50),
+                'latency_p95': percentile(timed_backend.latencies, 95),
+                'memory_peak_mb': round(memory_peak / 1024 / 1024, 2),
+                'io': io_counts,
+                'counters': stages['counters'],
+                'stages_seconds': {name: round(timer['sum'], 4) for name, timer in stages['timers'].items()
+                                   if name.endswith('_seconds')},
+           }
+
+
+def commit_get():
+    result = subprocess_run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                            cwd=Path(__file__).parent)
+    return result.stdout.strip() if result.returncode == 0 else 'unknown'
+
+
+def env_make(latency):
+    chat_server, chat_url = stub_servers.server_start(stub_servers.ChatStubHandler)
+    speach_server, speach_url = stub_servers.server_start(stub_servers.SpeachStubHandler)
+    dict_server, dict_url = stub_servers.server_start(stub_servers.SpanishDictStubHandler)
+    stub_servers.ChatStubHandler.configure(latency=latency)
+
+    timed_backend = TimedBackend(gpt_helper.OpenAIBackend(url=f'{chat_url}/v1/chat/completions', api_token='bench'))
+    gpt_helper.set_backend(timed_backend)
+    gpt_helper.cache.enabled = False
+    gpt_helper.limiter = RateLimiter()
+    spanish_dict.url = dict_url
+
+    return {
+                'servers': [chat_server, speach_server, dict_server],
+                'backend': timed_backend,
+                'speach': MSSpeach('bench', 'bench', tts_api_url=f'{speach_url}/cognitiveservices',
+                                   token_api_url=f'{speach_url}/sts'),
+                'io_counter': IOCounter(),
+           }
+
+
+def benchmarks_run(sizes, cases, latency=0.0):
+    env = env_make(latency)
+    results = []
+    try:
+        for size in sizes:
+            for case in cases:
+                result = case_run(case, size, env)
+                print(f"{case:<20} {size:>8} {result['seconds']:>9}s {result['words_per_sec']:>10} w/s "
+                      f"p95 {result['latency_p95']} mem {result['memory_peak_mb']}MB io {result['io']}")
+                results.append(result)
+    finally:
+        for server in env['servers']:
+            server.shutdown()
+
+    return {
+                'commit': commit_get(),
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'python': sys.version.split()[0],
+                'mock_latency': latency,
+                'results': results,
+           }
+
+
+def results_save(data, folder=results_folder):
+    folder.mkdir(parents=True, exist_ok=True)
+    file = folder.joinpath(f"{data['date'].replace(':', '-')}-{data['commit']}.json")
+    file.write_text(json_dumps(data, indent=1), encoding='utf-8')
+    return file
+
+
+# prints change of time and memory of cases between two results files (ratio > 1 - slower / more memory)
+def results_compare(old_file, new_file):
+    old = {(item['case'], item['size']): item for item in json_loads(Path(old_file).read_text())['results']}
+    new = json_loads(Path(new_file).read_text())['results']
+    compared = []
+    for item in new:
+        old_item = old.get((item['case'], item['size']))
+        if not old_item:
+            continue
+        row = {
+                'case': item['case'],
+                'size': item['size'],
+                'time_ratio': round(item['seconds'] / old_item['seconds'], 2) if old_item['seconds'] else None,
+                'memory_ratio': round(item['memory_peak_mb'] / old_item['memory_peak_mb'], 2)
+                if old_item['memory_peak_mb'] else None,
+              }
+        compared.append(row)
+        print(f"{row['case']:<20} {row['size']:>8} time x{row['time_ratio']} memory x{row['memory_ratio']}")
+    return compared
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='benchmarks of vocabulary pipeline with local stand-ins of services')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--cases', nargs='+', default=list(cases_all), choices=cases_all)
+    parser.add_argument('--latency', type=float, default=0.0, help='latency of GPT mock (seconds)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files')
+    args = parser.parse_args()
+
+    if args.compare:
+        results_compare(*args.compare)
+    else:
+        print(f'saved to {results_save(benchmarks_run(args.sizes, args.cases, args.latency))}')
@@ -4,10 +4,13 @@ from json import load as j_load
 from json import dumps as j_dumps
 from time import sleep
 import concurrent.futures
-from csv import writer as csv_writer
+from itertools import chain
+from os import getpid
+from os import replace as os_replace
 from csv import DictWriter as csv_DictWriter
 from csv import DictReader as csv_DictReader
 from traceback import format_exc as traceback_format_exc
+from metrics import metrics
 
 
 def make_file_object(file, folder='', with_exception=False):
@@ -22,15 +25,35 @@ def words_standardize(words):
     return [uni_normalize('NFKD', word).strip() for word in words]
 
 
-def format_words_list(words: list, chunk_size=20):
+# tokens_budget - max estimated tokens (prompt + completion) of words in one chunk, 0 - only chunk_size is used
+# item_tokens - function, which estimates tokens for one word dict
+def format_words_list(words: list, chunk_size=20, tokens_budget=0, item_tokens=None):
     words = [{'id': index, 'word': word} for index, word in enumerate(words)]
-    return [
-        words[i: i + chunk_size]
-        for i in range(0, len(words), chunk_size)
-    ]
+    if not tokens_budget or not item_tokens:
+        return [
+            words[i: i + chunk_size]
+            for i in range(0, len(words), chunk_size)
+        ]
+
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for word in words:
+        word_tokens = item_tokens(word)
+        if chunk and (chunk_tokens + word_tokens > tokens_budget or len(chunk) >= chunk_size):
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(word)
+        chunk_tokens += word_tokens
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
 
 
 # file_prefix - filename, f.e. Spanish_vocab-vocabulary_name
+@metrics.timed('offset_file_make_seconds')
 def make_offset_file(file_prefix, offset_value, folder_path: str):
     file = Path(folder_path)
     file = file.joinpath(f'{file_prefix}.offset-{offset_value}.json')
@@ -39,11 +62,13 @@ def make_offset_file(file_prefix, offset_value, folder_path: str):
     return file
 
 
+@metrics.timed('offset_files_glob_seconds')
 def offsets_files_get(file_prefix: str, folder_path: str):
     offsets_path = Path(folder_path)
     return [offset_file for offset_file in offsets_path.glob(f'{file_prefix}.offset*')]
 
 
+@metrics.timed('offset_file_read_seconds')
 def offset_file_data_get(file: Path):
     with file.open() as file_data:
         json_data = j_load(file_data)
@@ -76,14 +101,46 @@ def merge_lists(lists: list):
 #
 #     return [word_id for word_id in ids_origin if word_id not in ids_modified]
 
-def check_missing(new_words: list, existing_words: list):
+def word_normalize(word):
+    return uni_normalize('NFKD', str(word)).casefold().strip()
+
+
+class WordsIndex:
+    """
+    set of normalized words (casefolded NFKD) for O(1) "is word already there" checks
+    for dicts both "word" and "whole_word" are added
+    """
+    def __init__(self, words=None):
+        self.words = set()
+        self.add(words or [])
+
+    def add(self, words: list):
+        for word in words:
+            if isinstance(word, str):
+                self.words.add(word_normalize(word))
+                continue
+            for key in ('word', 'whole_word'):
+                if word.get(key):
+                    self.words.add(word_normalize(word[key]))
+
+    def __contains__(self, word):
+        return word_normalize(word) in self.words
+
+    def __len__(self):
+        return len(self.words)
+
+
+# existing_words - list of words (str or dict) or WordsIndex
+def check_missing(new_words: list, existing_words):
+    if not new_words:
+        return []
+
     if isinstance(new_words[0], dict):
         new_words = [word['word'] for word in new_words]
     new_words = [word.lower().strip() for word in new_words]
 
-    if existing_words and isinstance(existing_words[0], dict):
-        existing_words = [word['whole_word'].lower() for word in existing_words] + \
-                         [word['word'].lower() for word in existing_words]
+    if not isinstance(existing_words, WordsIndex):
+        existing_words = WordsIndex(existing_words)
 
     return [word for word in new_words if word not in existing_words]
 
@@ -109,20 +166,22 @@ def thread_func(words_list: list, from_lang, to_lang):
 
 
 # words lists has structure [ [{},{}], [{},{}], ... ]
+@metrics.timed('threads_run_seconds')
 def threads_run(function, function_data: list = None, function_kwargs: list = None, max_workers=5, ):
     result_list = []
     if function_kwargs is None:
         function_kwargs = []
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(function, data_chunk, *function_kwargs) for data_chunk in function_data]
+        futures = {executor.submit(function, data_chunk, *function_kwargs): data_chunk for data_chunk in function_data}
 
         for future in concurrent.futures.as_completed(futures):
             try:
                 result = future.result()
-                result_list.append({'result': result, 'error': None})
+                result_list.append({'result': result, 'error': None, 'data': futures[future]})
             except Exception as e:
-                result_list.append({'result': None, 'error': e})
+                result_list.append({'result': None, 'error': e, 'data': futures[future]})
+                metrics.count('threads_errors')
 
     return result_list
     # Merge all dictionaries into a single dictionary
@@ -139,16 +198,54 @@ def find_matching_files(directory, string, extension):
     return matching_files
 
 
-def write_data_to_csv_file(file_name: str, data_list: list):
+# writes rows (any iterable of dicts, f.e. generator) to temp file, then renames it to file,
+# so file is never half written and can be rewritten while it is being read (rows are read lazily)
+# fieldnames - taken from first row if not set
+@metrics.timed('csv_write_seconds')
+def write_rows_to_csv_file(file, rows, fieldnames=None, extrasaction='raise'):
+    file = Path(file)
+    rows = iter(rows)
+    if fieldnames is None:
+        first_row = next(rows, None)
+        fieldnames = list(first_row.keys()) if first_row else []
+        rows = chain([first_row], rows) if first_row else rows
+
+    temp_file = file.with_name(f'.{file.name}.{getpid()}.tmp')
+    try:
+        with open(temp_file, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv_DictWriter(csvfile, fieldnames=fieldnames, restval='', extrasaction=extrasaction)
+            writer.writeheader()
+            writer.writerows(rows)
+        os_replace(temp_file, file)
+    except Exception:
+        temp_file.unlink(missing_ok=True)
+        raise
+    return file
+
+
+# parts - csv text of rows without header (f.e. post_process.PostProcessor.csv_parts()), file is written as
+# write_rows_to_csv_file does (temp file, then rename)
+@metrics.timed('csv_write_seconds')
+def write_csv_parts_to_file(file, fieldnames: list, parts):
+    file = Path(file)
+    temp_file = file.with_name(f'.{file.name}.{getpid()}.tmp')
+    try:
+        with open(temp_file, 'w', newline='', encoding='utf-8') as csvfile:
+            csv_DictWriter(csvfile, fieldnames=fieldnames).writeheader()
+            for part in parts:
+                csvfile.write(part)
+        os_replace(temp_file, file)
+    except Exception:
+        temp_file.unlink(missing_ok=True)
+        raise
+    return file
+
+
+# columns are taken from first row, keys which are not in first row are skipped
+def write_data_to_csv_file(file_name: str, data_list):
     file_name = file_name + '.csv' if '.csv' not in file_name else file_name
     file = Path(file_name)
-    with open(file.absolute(), encoding="utf-8", mode="w", newline='') as new_file:
-        writer = csv_writer(new_file)
-        headers = data_list[0].keys()
-        other_rows = [obj.values() for obj in data_list]
-        writer.writerow(headers)
-        writer.writerows(other_rows)
-    return file
+    return write_rows_to_csv_file(file, data_list, extrasaction='ignore')
 
 
 def write_data_to_json_file(file: Path, data):
@@ -157,30 +254,29 @@ def write_data_to_json_file(file: Path, data):
     return file
 
 
-def load_data_from_csv_file(file_path: str, folder=''):
-    file_obj = make_file_object(folder, file_path, with_exception=True)
-    data = []
+@metrics.timed('csv_fieldnames_seconds')
+def csv_fieldnames_get(file_path, folder=''):
+    file_obj = make_file_object(file_path, folder, with_exception=True)
     with open(str(file_obj), mode='r', encoding='utf-8') as file:
-        reader = csv_DictReader(file)
-        for row in reader:
-            data.append(row)
-    return data
+        return csv_DictReader(file).fieldnames or []
 
 
-def save_as_csv(list_of_dicts, file_name: str, folder_path=''):
-    file = make_file_object(file_name, folder_path)
-    if file.suffix != '.csv':
-        file = file.with_suffix('.csv')
+# generator of rows, so file is never loaded to memory as a whole
+def iter_data_from_csv_file(file_path, folder=''):
+    file_obj = make_file_object(file_path, folder, with_exception=True)
+    with open(str(file_obj), mode='r', encoding='utf-8') as file:
+        yield from csv_DictReader(file)
+
 
-    if file.exists():
-        file.unlink()
+@metrics.timed('csv_read_seconds')
+def load_data_from_csv_file(file_path, folder=''):
+    return list(iter_data_from_csv_file(file_path, folder))
 
-    file_path = str(file)
-    keys = list_of_dicts[0].keys() if list_of_dicts else []
 
-    with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv_DictWriter(csvfile, fieldnames=keys)
-        writer.writeheader()
-        writer.writerows(list_of_dicts)
+# list_of_dicts - list or any iterable of dicts
+def save_as_csv(list_of_dicts, file_name, folder_path='', fieldnames=None):
+    file = make_file_object(file_name, folder_path)
+    if file.suffix != '.csv':
+        file = file.with_suffix('.csv')
 
-    return Path(file_path)
\ No newline at end of file
+    return write_rows_to_csv_file(file, list_of_dicts, fieldnames=fieldnames)
@@ -0,0 +1,124 @@
+from pathlib import Path
+from hashlib import sha256
+from json import dumps as json_dumps
+from json import loads as json_loads
+from time import time
+from threading import Lock
+from threading import get_ident
+from os import replace as os_replace
+
+
+def make_cache_key(model, messages):
+    data = json_dumps({'model': model, 'messages': messages}, sort_keys=True, ensure_ascii=False)
+    return sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    on-disk cache of chat responses, one json file per request (named by hash of model + messages),
+    so a crashed or repeated run does not pay again for chunks which were already answered
+        max_entries - oldest files are removed when there are more files than that (0 - no limit)
+        max_age - files older than that (seconds) are treated as missing and removed (0 - no limit)
+    """
+    def __init__(self, folder='.gpt_cache', max_entries=10000, max_age=30 * 24 * 3600, enabled=True):
+        self.folder = Path(folder)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.entries = None
+        self.lock = Lock()
+
+    def file_get(self, key):
+        return self.folder.joinpath(key[:2], f'{key}.json')
+
+    def get(self, key):
+        file = self.file_get(key)
+        if not self.enabled or not file.exists():
+            with self.lock:
+                self.misses += 1
+            return None
+
+        if self.max_age and time() - file.stat().st_mtime > self.max_age:
+            file.unlink(missing_ok=True)
+            with self.lock:
+                self.misses += 1
+            return None
+
+        try:
+            data = json_loads(file.read_text(encoding='utf-8'))
+        except ValueError:
+            file.unlink(missing_ok=True)
+            data = None
+
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def set(self, key, data):
+        if not self.enabled:
+            return None
+
+        file = self.file_get(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        # write to temp file first, so a crash never leaves half written entry
+        temp_file = file.with_suffix(f'.{get_ident()}.tmp')
+        temp_file.write_text(json_dumps(data, ensure_ascii=False), encoding='utf-8')
+        is_new = not file.exists()
+        os_replace(temp_file, file)
+
+        with self.lock:
+            if self.entries is None:
+                self.entries = len(self.files_get())
+            elif is_new:
+                self.entries += 1
+            to_evict = self.max_entries and self.entries > self.max_entries
+        if to_evict:
+            self.evict()
+        return file
+
+    # f.e. answer which was cached, but turned out to be not usable (words are missing), so it's requested again
+    def delete(self, key):
+        file = self.file_get(key)
+        if not file.exists():
+            return False
+        file.unlink(missing_ok=True)
+        with self.lock:
+            if self.entries:
+                self.entries -= 1
+        return True
+
+    def files_get(self):
+        return list(self.folder.glob('*/*.json'))
+
+    # removes oldest files down to 90% of max_entries, so eviction does not run on every new entry
+    def evict(self):
+        files = self.files_get()
+        keep = int(self.max_entries * 0.9)
+        removed = []
+        if len(files) > keep:
+            files = sorted(files, key=lambda file: file.stat().st_mtime)
+            removed = files[:len(files) - keep]
+            for file in removed:
+                file.unlink(missing_ok=True)
+
+        with self.lock:
+            self.entries = len(files) - len(removed)
+        return removed
+
+    def clear(self):
+        for file in self.files_get():
+            file.unlink(missing_ok=True)
+        with self.lock:
+            self.entries = 0
+
+    def stats(self):
+        return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self.files_get()),
+               }
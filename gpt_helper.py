@@ -5,35 +5,239 @@
 
 from time import sleep
 from datetime import datetime
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
+import aiohttp
 from dotenv import load_dotenv
 load_dotenv()
 from os import getenv
+from json import dumps as json_dumps
+from json import loads as json_loads
+from pathlib import Path
+from threading import Lock
+from gpt_cache import ResponseCache, make_cache_key
+from rate_limiter import RateLimiter, retry_after_get, backoff_delay
+from metrics import metrics
 
 
-token = getenv('OPENAI_TOKEN')
-chat_url = getenv('CHAT_URL')
 model = "gpt-3.5-turbo"
+cache = ResponseCache(folder=getenv('GPT_CACHE_FOLDER', '.gpt_cache'),
+                      enabled=getenv('GPT_CACHE_DISABLED', '').lower() not in ('1', 'true', 'yes'))
 
 
-def make_request(method, url, data=None, headers=None, params=None):
+# one keep-alive session for all requests of threads, so connections are reused, not opened per chunk
+def make_session(pool_size=100):
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+    return new_session
+
+
+pool_size = int(getenv('GPT_POOL_SIZE', 100))
+session = make_session(pool_size)
+# aiohttp sessions of event loops (session can be used only in loop where it was created)
+async_sessions = {}
+limiter = RateLimiter(requests_per_minute=int(getenv('GPT_RPM', 3500)), tokens_per_minute=int(getenv('GPT_TPM', 90000)))
+max_retries = int(getenv('GPT_MAX_RETRIES', 5))
+completion_tokens = 1500
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+# rough estimation (~4 characters per token), used for limiter only
+def tokens_estimate(text):
+    return len(text) // 4 + 1
+
+
+# one keep-alive aiohttp session per event loop, closed by async_session_close() at the end of async work
+def async_session_get():
+    loop = asyncio.get_running_loop()
+    async_session = async_sessions.get(loop)
+    if async_session is None or async_session.closed:
+        async_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size),
+                                              timeout=aiohttp.ClientTimeout(total=None, sock_read=600))
+        async_sessions[loop] = async_session
+    return async_session
+
+
+async def async_session_close():
+    async_session = async_sessions.pop(asyncio.get_running_loop(), None)
+    if async_session is not None:
+        await async_session.close()
+
+
+def stream_completion_make():
+    return {'id': '', 'model': '', 'created': 0, 'usage': {}, 'parts': [],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]}
+
+
+# one line of server-sent events is added to completion, returns False when stream is finished
+def stream_line_add(completion, line, on_delta=None):
+    if not line or not line.startswith('data:'):
+        return True
+    line = line[len('data:'):].strip()
+    if line == '[DONE]':
+        return False
+
+    event = json_loads(line)
+    for field in ('id', 'model', 'created', 'usage'):
+        if event.get(field):
+            completion[field] = event[field]
+    for choice in event.get('choices') or []:
+        text = (choice.get('delta') or {}).get('content')
+        if text:
+            completion['parts'].append(text)
+            if on_delta:
+                on_delta(text)
+        if choice.get('finish_reason'):
+            completion['choices'][0]['finish_reason'] = choice['finish_reason']
+    return True
+
+
+def stream_completion_finish(completion):
+    completion['choices'][0]['message']['content'] = ''.join(completion.pop('parts'))
+    return completion
+
+
+# reads server-sent events of streamed chat completion, on_delta gets every part of message text
+# returns completion as not streamed request does (message content is joined from parts)
+def stream_read(res, on_delta=None):
+    completion = stream_completion_make()
+    for line in res.iter_lines(decode_unicode=True):
+        if not stream_line_add(completion, line, on_delta):
+            break
+    return stream_completion_finish(completion)
+
+
+async def async_stream_read(res, on_delta=None):
+    completion = stream_completion_make()
+    async for line in res.content:
+        if not stream_line_add(completion, line.decode('utf-8').strip(), on_delta):
+            break
+    return stream_completion_finish(completion)
+
+
+# api_token - OPENAI_TOKEN if not set (read on request, not on import)
+def request_headers_make(headers=None, api_token=None):
+    headers = {'Content-Type': 'application/json'} if not headers else headers
+    headers['Authorization'] = 'Bearer ' + (api_token if api_token else getenv('OPENAI_TOKEN') or '')
+    return headers
+
+
+# delay before next attempt of request which got retry status, on 429 all workers are paused
+def retry_delay_get(status_code, headers, attempt, tokens):
+    delay = retry_after_get(headers)
+    delay = backoff_delay(attempt) if delay is None else delay
+    metrics.observe('gpt_backoff_seconds', delay)
+    limiter.retry_add()
+    metrics.count('gpt_retries')
+    if status_code == 429:
+        # all workers wait (in acquire), rejected request did not use its tokens
+        limiter.pause(delay)
+        limiter.adjust(tokens, 0)
+        return 0
+    return delay
+
+
+# tokens - estimated tokens of request, taken from tokens-per-minute limit before sending
+# api_token - OPENAI_TOKEN if not set
+# stream - answer is read as server-sent events, on_delta gets parts of message as soon as they come
+def make_request(method, url, data=None, headers=None, params=None, tokens=0, api_token=None, stream=False,
+                 on_delta=None):
     method = method.lower()
     data = {} if not data else data
     params = {} if not params else params
-    headers = {'Content-Type': 'application/json'} if not headers else headers
-    headers['Authorization'] = 'Bearer ' + token
+    headers = request_headers_make(headers, api_token)
+
+    attempt = 0
+    while True:
+        limiter.acquire(tokens)
+        with metrics.timer('gpt_request_seconds'):
+            res = session.request(method, url, headers=headers, json=data, params=params, stream=stream)
+        limiter.update_from_headers(res.headers)
+        metrics.count(f'gpt_status_{res.status_code}')
+        if res.status_code not in retry_statuses or attempt >= max_retries:
+            break
+        res.close()
 
-    res = getattr(requests, method)(url, headers=headers, json=data, params=params)
-    if res.status_code == 429:
-        sleep(30)
-        res = getattr(requests, method)(url, headers=headers, json=data, params=params)
+        delay = retry_delay_get(res.status_code, res.headers, attempt, tokens)
+        if delay:
+            sleep(delay)
+        attempt += 1
 
     success = res.status_code == 200
-    data = res.json() if success else res.text
+    try:
+        if success and stream:
+            with metrics.timer('gpt_stream_seconds'):
+                data = stream_read(res, on_delta)
+        else:
+            data = res.json() if success else res.text
+    except (ValueError, requests.RequestException):
+        success = False
+        data = res.text
+        metrics.count('gpt_invalid_json')
+
+    if success and tokens and data.get('usage'):
+        limiter.adjust(tokens, data['usage']['total_tokens'])
+
     return {
                 'success': success,
                 'status_code': res.status_code,
                 'data': data,
+                'attempts': attempt + 1,
+           }
+
+
+# make_request on aiohttp session of running event loop, requests wait for limiter and backoff without threads
+async def async_make_request(method, url, data=None, headers=None, params=None, tokens=0, api_token=None,
+                             stream=False, on_delta=None):
+    method = method.upper()
+    data = {} if not data else data
+    params = {} if not params else params
+    headers = request_headers_make(headers, api_token)
+    async_session = async_session_get()
+
+    attempt = 0
+    while True:
+        await limiter.async_acquire(tokens)
+        with metrics.timer('gpt_request_seconds'):
+            res = await async_session.request(method, url, headers=headers, json=data, params=params)
+            body = await res.read() if res.status != 200 or not stream else b''
+        limiter.update_from_headers(res.headers)
+        metrics.count(f'gpt_status_{res.status}')
+        if res.status not in retry_statuses or attempt >= max_retries:
+            break
+        res.release()
+
+        delay = retry_delay_get(res.status, res.headers, attempt, tokens)
+        if delay:
+            await asyncio.sleep(delay)
+        attempt += 1
+
+    success = res.status == 200
+    text = body.decode('utf-8', errors='replace')
+    try:
+        if success and stream:
+            with metrics.timer('gpt_stream_seconds'):
+                data = await async_stream_read(res, on_delta)
+        else:
+            data = json_loads(text) if success else text
+    except (ValueError, aiohttp.ClientError) as e:
+        success = False
+        data = text or f'broken stream: {e}'
+        metrics.count('gpt_invalid_json')
+    finally:
+        res.release()
+
+    if success and tokens and data.get('usage'):
+        limiter.adjust(tokens, data['usage']['total_tokens'])
+
+    return {
+                'success': success,
+                'status_code': res.status,
+                'data': data,
+                'attempts': attempt + 1,
            }
 
 
@@ -71,13 +275,138 @@ def make_request(method, url, data=None, headers=None, params=None):
 #                 }
 
 
+class ChatBackend:
+    """
+    interface of chat backends used by send_question
+    send() gets list of messages and returns result as make_request does:
+        {'success': bool, 'status_code': int, 'data': chat completion (openai format) or error text, 'attempts': int}
+    on_delta - if set, answer is streamed and on_delta gets parts of message text as they come
+               (backends which can't stream call it once with the whole message)
+    """
+    model = model
+
+    def send(self, messages: list, on_delta=None):
+        raise NotImplementedError
+
+    # coroutine version of send(), backends without async client run send() in thread
+    async def async_send(self, messages: list, on_delta=None):
+        return await asyncio.to_thread(self.send, messages, on_delta)
+
+
+def message_deliver(response, on_delta=None):
+    if on_delta and response['success']:
+        on_delta(response['data']['choices'][0]['message']['content'])
+    return response
+
+
+class OpenAIBackend(ChatBackend):
+    # url / api_token - CHAT_URL / OPENAI_TOKEN if not set (read when backend is created, not on import)
+    def __init__(self, url=None, api_token=None, chat_model=model):
+        self.url = url if url else getenv('CHAT_URL')
+        self.api_token = api_token if api_token else getenv('OPENAI_TOKEN')
+        self.model = chat_model
+
+    def request_make(self, messages: list, on_delta=None):
+        data = {
+                    "model": self.model,
+                    "messages": messages
+                }
+        if on_delta:
+            data['stream'] = True
+            data['stream_options'] = {'include_usage': True}
+        tokens = tokens_estimate(json_dumps(messages, ensure_ascii=False)) + completion_tokens
+        return {'method': 'POST', 'url': self.url, 'data': data, 'tokens': tokens, 'api_token': self.api_token,
+                'stream': bool(on_delta), 'on_delta': on_delta}
+
+    def send(self, messages: list, on_delta=None):
+        return make_request(**self.request_make(messages, on_delta))
+
+    async def async_send(self, messages: list, on_delta=None):
+        return await async_make_request(**self.request_make(messages, on_delta))
+
+
+class ReplayBackend(ChatBackend):
+    """
+    mode "record" - requests are sent to backend and successful responses are saved to jsonl file
+    mode "replay" - responses are taken from file only (by hash of model + messages), nothing is sent,
+                    not recorded request gets result with status 404
+    so the same run can be repeated offline with the same answers (benchmarks, debugging)
+    """
+    def __init__(self, file, mode='replay', backend: ChatBackend = None):
+        self.file = Path(file)
+        self.mode = mode
+        self.backend = backend if backend else OpenAIBackend()
+        self.model = self.backend.model
+        self.responses = {}
+        self.lock = Lock()
+        if self.file.exists():
+            with self.file.open(encoding='utf-8') as records:
+                for line in records:
+                    try:
+                        record = json_loads(line)
+                    except ValueError:
+                        continue
+                    self.responses[record['key']] = record['response']
+
+    def replay(self, key, on_delta=None):
+        response = self.responses.get(key)
+        if response is None:
+            return {'success': False, 'status_code': 404, 'data': 'request was not recorded', 'attempts': 1}
+        return message_deliver(dict(response), on_delta)
+
+    def record(self, key, response):
+        if response['success']:
+            with self.lock:
+                self.responses[key] = response
+                with self.file.open('a', encoding='utf-8') as records:
+                    records.write(json_dumps({'key': key, 'response': response}, ensure_ascii=False) + '\n')
+        return response
+
+    def send(self, messages: list, on_delta=None):
+        key = make_cache_key(self.model, messages)
+        if self.mode == 'replay':
+            return self.replay(key, on_delta)
+        return self.record(key, self.backend.send(messages, on_delta=on_delta))
+
+    async def async_send(self, messages: list, on_delta=None):
+        key = make_cache_key(self.model, messages)
+        if self.mode == 'replay':
+            return self.replay(key, on_delta)
+        return self.record(key, await self.backend.async_send(messages, on_delta=on_delta))
+
+
+backend = None
+
+
+# GPT_BACKEND: openai (default) - CHAT_URL, mock - local mock server on GPT_MOCK_URL (see stub_servers),
+#              record / replay - ReplayBackend with GPT_REPLAY_FILE (record sends requests to CHAT_URL)
+def backend_get():
+    global backend
+    if backend is None:
+        backend_name = getenv('GPT_BACKEND', 'openai').lower()
+        if backend_name == 'mock':
+            backend = OpenAIBackend(url=getenv('GPT_MOCK_URL', 'http://127.0.0.1:8765/v1/chat/completions'),
+                                    api_token='mock')
+        elif backend_name in ('record', 'replay'):
+            backend = ReplayBackend(getenv('GPT_REPLAY_FILE', 'gpt_replay.jsonl'), mode=backend_name)
+        else:
+            backend = OpenAIBackend()
+    return backend
+
+
+def set_backend(new_backend: ChatBackend):
+    global backend
+    backend = new_backend
+    return backend
+
+
 def format_chat_output(output_org):
         output = output_org['data']
         output_org['data'] = {
                                 'message': output['choices'][0]['message']['content'],
                                 'output_length': len(output['choices'][0]['message']['content']),
                                 'finish_reason': output['choices'][0]['finish_reason'],
-                                'tokens_used': output['usage']['total_tokens'],
+                                'tokens_used': (output.get('usage') or {}).get('total_tokens', 0),
                                 'chat_model': output['model'],
                                 'chat_id': output['id'],
                                 'timestamp': output['created'],
@@ -86,18 +415,73 @@ def format_chat_output(output_org):
         return output_org
 
 
-def send_question(question, history=None, beautify=True):
+def messages_make(question, history=None):
     messages = [{"role": "user", "content": question}]
-
     if history:
         messages = history + messages
+    return messages
+
+
+def cached_answer_get(cache_key, on_delta=None):
+    res = cache.get(cache_key)
+    if res:
+        res['cached'] = True
+        metrics.count('gpt_cache_hits')
+        message_deliver(res, on_delta)
+    return res
+
+
+# metrics of new answer, only complete answers are cached, truncated or not usable ones should be requested again
+def answer_register(res, cache_key, cache_check=None):
+    res['cached'] = False
+    metrics.count('gpt_requests')
+    metrics.observe('gpt_chunk_retries', res.get('attempts', 1) - 1)
+    if res['success']:
+        metrics.tokens_add(res['data'])
+    else:
+        metrics.count('gpt_errors')
+    if res['success'] and res['data']['choices'][0]['finish_reason'] != 'length':
+        if cache_check is None or cache_check(res['data']['choices'][0]['message']['content']):
+            cache.set(cache_key, res)
+        else:
+            metrics.count('gpt_cache_rejected')
+    return res
+
+
+# use_cache=False - bypass cache (answer is requested again and the cached one is replaced)
+# on_delta - answer is streamed, function gets parts of message text as they come (whole message if it's cached)
+# cache_check - function of answer message, answer is cached only if it returns True (f.e. answer is valid json)
+# result has "cache_key", so caller can remove answer from cache later (cache.delete)
+@metrics.timed('send_question_seconds')
+def send_question(question, history=None, beautify=True, use_cache=True, on_delta=None, cache_check=None):
+    messages = messages_make(question, history)
+    chat_backend = backend_get()
+    cache_key = make_cache_key(chat_backend.model, messages)
+    res = cached_answer_get(cache_key, on_delta) if use_cache else None
+    if not res:
+        res = chat_backend.send(messages, on_delta=on_delta) if on_delta else chat_backend.send(messages)
+        answer_register(res, cache_key, cache_check)
+    res['cache_key'] = cache_key
+
+    if beautify:
+        res = format_chat_output(res) if res['success'] else res
+    return res
+
 
-    data = {
-                "model": model,
-                "messages": messages
-            }
+# send_question for coroutines, backend request runs on aiohttp session of running loop (see async_session_get),
+# so number of requests in work is limited only by caller (f.e. semaphore), not by threads
+async def async_send_question(question, history=None, beautify=True, use_cache=True, on_delta=None,
+                              cache_check=None):
+    with metrics.timer('send_question_seconds'):
+        messages = messages_make(question, history)
+        chat_backend = backend_get()
+        cache_key = make_cache_key(chat_backend.model, messages)
+        res = cached_answer_get(cache_key, on_delta) if use_cache else None
+        if not res:
+            res = await chat_backend.async_send(messages, on_delta=on_delta)
+            answer_register(res, cache_key, cache_check)
+        res['cache_key'] = cache_key
 
-    res = make_request('POST', chat_url, data=data)
     if beautify:
         res = format_chat_output(res) if res['success'] else res
     return res
@@ -1,5 +1,6 @@
 from pathlib import Path
-from gpt_helper import send_question
+from json import loads as json_loads
+from gpt_helper import send_question, tokens_estimate
 
 
 # ask chat to define word Level optional?
@@ -38,6 +39,21 @@ def create_request_message(from_lang, to_lang, vocab_source, vocab_name, level):
 
 
 
+# estimated tokens for one word: word in request + dictionary with all fields in reply
+def word_tokens_estimate(word: dict):
+    request_tokens = tokens_estimate(str(word))
+    # word is repeated in word/whole_word/translation/sentence, sentence with translation ~ 2x30, field names ~ 90
+    return request_tokens + 4 * tokens_estimate(word['word']) + 60 + 90
+
+
+# answer of request message is usable (and can be cached) only if it's json list of words
+def answer_check(message: str):
+    try:
+        return isinstance(json_loads(message), list)
+    except ValueError:
+        return False
+
+
 message2 = 'To fill this CSV file use a list of Spanish words required for level A1, ' \
            'I know there are different standards and criteria used by different organizations and countries, ' \
            'so I leave it to you to choose'
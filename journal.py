@@ -0,0 +1,76 @@
+from pathlib import Path
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os import fsync
+from threading import Lock
+from metrics import metrics
+
+
+class Journal:
+    """
+    append-only jsonl file (one record per line) with results of all chunks of one vocabulary
+    replaces offset files: one file to append and read instead of one file per chunk
+        fsync_every - fsync file after so many appends (and on close), flush happens on every append
+    a line which was not written completely (crash) is skipped on read
+    """
+    def __init__(self, file, fsync_every=20):
+        self.file = Path(file)
+        self.fsync_every = fsync_every
+        self.not_synced = 0
+        self.file_obj = None
+        self.lock = Lock()
+
+    @metrics.timed('journal_append_seconds')
+    def append(self, records: list):
+        if not records:
+            return 0
+
+        data = ''.join(json_dumps(record, ensure_ascii=False) + '\n' for record in records)
+        with self.lock:
+            if not self.file_obj:
+                self.file.parent.mkdir(parents=True, exist_ok=True)
+                self.file_obj = self.file.open('a', encoding='utf-8')
+            self.file_obj.write(data)
+            self.file_obj.flush()
+            self.not_synced += 1
+            if self.not_synced >= self.fsync_every:
+                self.sync()
+        return len(records)
+
+    def sync(self):
+        if self.file_obj and self.not_synced:
+            fsync(self.file_obj.fileno())
+            self.not_synced = 0
+
+    def close(self):
+        with self.lock:
+            if self.file_obj:
+                self.sync()
+                self.file_obj.close()
+                self.file_obj = None
+
+    def read(self):
+        if not self.file.exists():
+            return []
+
+        records = []
+        with self.file.open(encoding='utf-8') as file_data:
+            for line in file_data:
+                try:
+                    records.append(json_loads(line))
+                except ValueError:
+                    continue
+        return records
+
+    # unique records by key (last written wins), order of first appearance is kept
+    @metrics.timed('journal_compact_seconds')
+    def compact(self, key='word'):
+        records = {}
+        for index, record in enumerate(self.read()):
+            record_key = str(record.get(key, '')).lower().strip() if isinstance(record, dict) else None
+            records[record_key if record_key else ('', index)] = record
+        return list(records.values())
+
+    def delete(self):
+        self.close()
+        self.file.unlink(missing_ok=True)
@@ -0,0 +1,87 @@
+from json import loads as json_loads
+
+
+class JSONArrayParser:
+    """
+    incremental parser of json array of objects (answer of chatGPT with words), text is fed by parts
+    feed() returns objects which were completed by this part, so they can be saved before the answer ends
+        parser = JSONArrayParser()
+        for delta in stream: items = parser.feed(delta)
+    text before "[" (f.e. "Here is the list:") is skipped, object which is not valid json is skipped and counted
+    in errors, not finished object at the end is just never returned, so broken tail costs only its objects
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.started = False
+        self.finished = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.item_start = None
+        self.items_count = 0
+        self.errors = 0
+
+    def feed(self, text: str):
+        items = []
+        if self.finished or not text:
+            return items
+
+        self.buffer += text
+        buffer = self.buffer
+        position = self.position
+        while position < len(buffer):
+            char = buffer[position]
+            if not self.started:
+                if char == '[':
+                    self.started = True
+                position += 1
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                if self.depth == 0:
+                    self.item_start = position
+                self.depth += 1
+            elif char in '}]':
+                if self.depth == 0 and char == ']':
+                    self.finished = True
+                    position += 1
+                    break
+                self.depth -= 1
+                if self.depth == 0 and self.item_start is not None:
+                    item = self.item_get(buffer[self.item_start: position + 1])
+                    if item is not None:
+                        items.append(item)
+                    self.item_start = None
+            position += 1
+
+        # text of finished objects is not needed anymore
+        cut = self.item_start if self.item_start is not None else position
+        self.buffer = buffer[cut:]
+        self.position = position - cut
+        if self.item_start is not None:
+            self.item_start = 0
+        return items
+
+    def item_get(self, text):
+        try:
+            item = json_loads(text)
+        except ValueError:
+            self.errors += 1
+            return None
+        self.items_count += 1
+        return item
+
+
+# all complete objects of (maybe broken) json array text
+def array_items(text: str):
+    return JSONArrayParser().feed(text)
@@ -0,0 +1,79 @@
+import sqlite3
+from json import dumps as json_dumps
+from json import loads as json_loads
+from time import time
+from threading import Lock
+from pathlib import Path
+from extra_functions import word_normalize
+
+# fields which don't depend on vocabulary (source / list), so they are shared by all vocabularies of language pair
+lexicon_fields = ('word', 'whole_word', 'word_translation', 'sentence', 'sentence_translation', 'type',
+                  'is_irregular', 'level', 'language', 'to_language', 'topics')
+# max variables in one sqlite query
+query_size = 500
+
+
+class Lexicon:
+    """
+    words found by GPT for all vocabularies in sqlite file, key is (from_lang, to_lang, normalized word)
+    the same word in other list (Beginner, Food, Travel...) is taken from here, only vocabulary fields
+    (source, level of list) are set locally, so GPT is asked once per unique word of language pair
+    """
+    def __init__(self, file='lexicon.sqlite'):
+        self.file = Path(file)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = Lock()
+        self.connection = sqlite3.connect(str(self.file), timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS words (
+                                       from_lang TEXT NOT NULL,
+                                       to_lang TEXT NOT NULL,
+                                       word_key TEXT NOT NULL,
+                                       data TEXT NOT NULL,
+                                       updated REAL NOT NULL,
+                                       PRIMARY KEY (from_lang, to_lang, word_key)
+                                   )''')
+        self.connection.commit()
+
+    @staticmethod
+    def key_get(from_lang, to_lang, word):
+        return from_lang.lower().strip(), to_lang.lower().strip(), word_normalize(word)
+
+    # returns normalized word: lexicon fields for words which are in lexicon
+    def get_many(self, from_lang, to_lang, words: list):
+        keys = list({self.key_get(from_lang, to_lang, word)[2] for word in words})
+        from_lang, to_lang, _ = self.key_get(from_lang, to_lang, '')
+        found = {}
+        with self.lock:
+            for index in range(0, len(keys), query_size):
+                part = keys[index: index + query_size]
+                rows = self.connection.execute(
+                    f'SELECT word_key, data FROM words WHERE from_lang = ? AND to_lang = ? '
+                    f'AND word_key IN ({", ".join("?" * len(part))})', [from_lang, to_lang] + part)
+                found.update({word_key: json_loads(data) for word_key, data in rows})
+        return found
+
+    # words - word dicts (answers of GPT), words with not empty "word" are saved, newer data replaces older one
+    def put_many(self, from_lang, to_lang, words: list):
+        now = time()
+        rows = []
+        for word in words:
+            if not word.get('word'):
+                continue
+            key = self.key_get(from_lang, to_lang, word['word'])
+            data = {field: word.get(field) for field in lexicon_fields if word.get(field) not in (None, '')}
+            rows.append(key + (json_dumps(data, ensure_ascii=False), now))
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO words (from_lang, to_lang, word_key, data, updated) '
+                                        'VALUES (?, ?, ?, ?, ?)', rows)
+            self.connection.commit()
+        return len(rows)
+
+    # count of words of all language pairs
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM words').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
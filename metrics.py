@@ -0,0 +1,137 @@
+from time import perf_counter
+from functools import wraps
+from contextlib import contextmanager
+from threading import Lock
+from json import dumps as json_dumps
+from pathlib import Path
+from os import getenv
+from re import sub as re_sub
+
+
+# usd per 1000 tokens, GPT_PRICE_1K overrides price of any model
+model_prices = {
+                    'gpt-3.5-turbo': 0.002,
+                    'gpt-4': 0.06,
+               }
+
+
+def price_get(model):
+    price = getenv('GPT_PRICE_1K')
+    if price:
+        return float(price)
+    # answers have full model name (f.e. gpt-3.5-turbo-0613)
+    for name in sorted(model_prices, key=len, reverse=True):
+        if model and model.startswith(name):
+            return model_prices[name]
+    return 0.0
+
+
+class Metrics:
+    """
+    counters and timers of pipeline stages, shared by all threads
+        metrics.count('gpt_requests'), metrics.observe('gpt_chunk_retries', 2)
+        with metrics.timer('search_save_seconds'): ...
+        @metrics.timed('csv_write_seconds') - time of every call of function
+    observed values (timers) keep count / sum / min / max only, so memory does not grow with calls
+    hooks - functions called on every event as hook(kind, name, value), kind is "count" or "observe" (tracing, logs)
+    summary() / to_json() / to_prometheus() export everything collected since creation or reset()
+    """
+    def __init__(self, prefix='language_helper'):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.hooks = []
+        self.counters = {}
+        self.timers = {}
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timers = {}
+
+    def hooks_call(self, kind, name, value):
+        for hook in self.hooks:
+            try:
+                hook(kind, name, value)
+            except Exception:
+                pass
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.hooks_call('count', name, value)
+
+    def observe(self, name, value):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = {'count': 1, 'sum': value, 'min': value, 'max': value}
+            else:
+                timer['count'] += 1
+                timer['sum'] += value
+                timer['min'] = min(timer['min'], value)
+                timer['max'] = max(timer['max'], value)
+        self.hooks_call('observe', name, value)
+
+    @contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def timed(self, name):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # tokens and cost of one chat answer (raw openai response data)
+    def tokens_add(self, data: dict):
+        usage = data.get('usage') or {}
+        prompt_tokens = usage.get('prompt_tokens', 0)
+        completion_tokens = usage.get('completion_tokens', 0)
+        total_tokens = usage.get('total_tokens', prompt_tokens + completion_tokens)
+        self.count('gpt_tokens_prompt', prompt_tokens)
+        self.count('gpt_tokens_completion', completion_tokens)
+        self.count('gpt_tokens_total', total_tokens)
+        self.count('gpt_cost_usd', total_tokens / 1000 * price_get(data.get('model')))
+
+    def summary(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {name: dict(timer) for name, timer in self.timers.items()}
+        for timer in timers.values():
+            timer['avg'] = timer['sum'] / timer['count']
+        return {'counters': counters, 'timers': timers}
+
+    def to_json(self):
+        return json_dumps(self.summary(), indent=1)
+
+    def metric_name(self, name):
+        return re_sub(r'[^a-zA-Z0-9_]', '_', f'{self.prefix}_{name}')
+
+    def to_prometheus(self):
+        summary = self.summary()
+        lines = []
+        for name, value in sorted(summary['counters'].items()):
+            name = self.metric_name(name)
+            lines += [f'# TYPE {name} counter', f'{name} {value}']
+        for name, timer in sorted(summary['timers'].items()):
+            name = self.metric_name(name)
+            lines += [f'# TYPE {name} summary', f"{name}_count {timer['count']}", f"{name}_sum {timer['sum']}"]
+            lines += [f'# TYPE {name}_max gauge', f"{name}_max {timer['max']}"]
+        return '\n'.join(lines) + '\n'
+
+    # file with .prom / .txt extension - prometheus text, otherwise json
+    def export(self, file):
+        file = Path(file)
+        data = self.to_prometheus() if file.suffix in ('.prom', '.txt') else self.to_json()
+        file.write_text(data, encoding='utf-8')
+        return file
+
+
+metrics = Metrics()
@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import islice
+from io import StringIO
+from json import loads as json_loads
+from traceback import format_exc as traceback_format_exc
+from csv import DictWriter as csv_DictWriter
+from os import cpu_count
+import extra_functions
+from json_stream import array_items
+
+
+# functions below are run in processes of pool, so they are module level (picklable) and get plain data
+
+def words_standardize_batch(words: list):
+    return extra_functions.words_standardize(words)
+
+
+# answer (message) of chatGPT to words sorted by id, error - traceback if answer has no valid words
+def answer_parse(message: str):
+    try:
+        items = json_loads(message)
+        return {'items': sorted(items, key=lambda k: k['id']) if isinstance(items, list) else [], 'error': None,
+                'broken': False}
+    except Exception:
+        error = traceback_format_exc()
+    items = array_items(message)
+    return {'items': sorted(items, key=lambda k: k['id']), 'error': None if items else error, 'broken': True}
+
+
+def csv_text_make(rows: list, fieldnames: list, extrasaction='ignore', row_function=None):
+    data = StringIO()
+    writer = csv_DictWriter(data, fieldnames=fieldnames, restval='', extrasaction=extrasaction)
+    writer.writerows(map(row_function, rows) if row_function else rows)
+    return data.getvalue()
+
+
+class PostProcessor:
+    """
+    process pool for CPU work of pipeline (normalization, parsing of answers, tags, csv formatting),
+    so it runs on other cores at the same time as GPT requests (threads) and the main thread
+        batch_size - items sent to process at once, max_pending - batches in work at once (memory is bounded)
+    """
+    def __init__(self, max_workers=None, batch_size=2000, max_pending=None):
+        self.max_workers = max_workers or cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_pending = max_pending or self.max_workers * 2
+        self.executor = None
+
+    def executor_get(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.executor
+
+    def submit(self, function, *args, **kwargs):
+        return self.executor_get().submit(function, *args, **kwargs)
+
+    # results of function for batches of items (any iterable, f.e. generator of csv rows), in order of batches
+    def map_batches(self, function, items, *args, **kwargs):
+        items = iter(items)
+        pending = deque()
+        while True:
+            while len(pending) < self.max_pending:
+                batch = list(islice(items, self.batch_size))
+                if not batch:
+                    break
+                pending.append(self.submit(function, batch, *args, **kwargs))
+            if not pending:
+                return
+            yield pending.popleft().result()
+
+    def words_standardize(self, words: list):
+        standardized = []
+        for batch in self.map_batches(words_standardize_batch, words):
+            standardized += batch
+        return standardized
+
+    # rows are formatted to csv text in processes, main process only writes text (see write_csv_parts_to_file)
+    def csv_parts(self, rows, fieldnames: list, row_function=None):
+        rows = (row.to_dict() if hasattr(row, 'to_dict') else row for row in rows)
+        return self.map_batches(csv_text_make, rows, fieldnames, row_function=row_function)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
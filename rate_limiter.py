@@ -0,0 +1,163 @@
+from time import monotonic, sleep
+from threading import Lock
+from random import uniform
+from re import findall as re_findall
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import asyncio
+
+
+# parses durations from rate limit headers: "1s", "6m0s", "20ms", "0.5" -> seconds
+def duration_parse(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re_findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+# Retry-After is seconds or HTTP-date ("Wed, 21 Oct 2015 07:28:00 GMT")
+def date_delay_parse(value):
+    try:
+        date = parsedate_to_datetime(str(value))
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def retry_after_get(headers):
+    headers = headers or {}
+    delay_ms = duration_parse(headers.get('retry-after-ms'))
+    if delay_ms is not None:
+        return delay_ms / 1000
+    retry_after = headers.get('Retry-After')
+    delay = duration_parse(retry_after)
+    if delay is None and retry_after is not None:
+        delay = date_delay_parse(retry_after)
+    return delay
+
+
+# "full jitter" exponential backoff, so workers which failed together do not retry together
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    return uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.value = per_minute
+        self.updated = monotonic()
+
+    def refill(self, now):
+        self.value = min(self.capacity, self.value + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds to wait till amount is available (amount bigger than capacity waits for full bucket)
+    def wait_time(self, amount):
+        amount = min(amount, self.capacity)
+        return 0 if self.value >= amount else (amount - self.value) / self.rate
+
+
+class RateLimiter:
+    """
+    shared requests-per-minute and tokens-per-minute limiter for all threads and coroutines (async_acquire)
+        requests_per_minute, tokens_per_minute - 0 means no limit
+    pause() (on 429 or when headers say limit is reached) stops all workers, not only the one which got 429
+    """
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0
+        self.lock = Lock()
+        self.throttled_time = 0.0
+        self.throttled_count = 0
+        self.retries = 0
+
+    # takes request (and tokens) if limits allow it, otherwise returns seconds to wait
+    # waited - time already waited for this request, it's added to stats when request is taken
+    def try_acquire(self, tokens=0, waited=0.0):
+        with self.lock:
+            now = monotonic()
+            wait = max(self.paused_until - now, 0)
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                if bucket:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                if bucket:
+                    bucket.value -= min(amount, bucket.capacity)
+            if waited:
+                self.throttled_time += waited
+                self.throttled_count += 1
+            return 0
+
+    # small jitter, so waiting workers do not wake up all at once
+    @staticmethod
+    def jitter_add(wait):
+        return wait + uniform(0, min(wait * 0.1, 1))
+
+    def acquire(self, tokens=0):
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens, waited)
+            if wait <= 0:
+                return waited
+            wait = self.jitter_add(wait)
+            sleep(wait)
+            waited += wait
+
+    # acquire() for coroutines, waiting does not block event loop
+    async def async_acquire(self, tokens=0):
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens, waited)
+            if wait <= 0:
+                return waited
+            wait = self.jitter_add(wait)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    # corrects estimated tokens by real usage after response
+    def adjust(self, tokens_estimated, tokens_used):
+        if not self.tokens:
+            return
+        with self.lock:
+            self.tokens.value -= tokens_used - tokens_estimated
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+    def retry_add(self):
+        with self.lock:
+            self.retries += 1
+
+    # openai sends x-ratelimit-remaining-*/x-ratelimit-reset-* headers, pause till reset if nothing left
+    def update_from_headers(self, headers):
+        headers = headers or {}
+        for limit in ('requests', 'tokens'):
+            remaining = headers.get(f'x-ratelimit-remaining-{limit}')
+            reset = duration_parse(headers.get(f'x-ratelimit-reset-{limit}'))
+            if remaining is not None and reset and float(remaining) < 1:
+                self.pause(reset)
+
+    def stats(self):
+        return {
+                    'throttled_time': round(self.throttled_time, 3),
+                    'throttled_count': self.throttled_count,
+                    'retries': self.retries,
+               }
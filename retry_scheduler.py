@@ -0,0 +1,121 @@
+from heapq import heappush, heappop
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
+from metrics import metrics
+
+retry_priority = 0
+new_priority = 1
+
+
+class RetryScheduler:
+    """
+    priority queue of chunks of words ({'id': .., 'word': ..}), chunks of retried words go before new ones
+    run() sends chunks in threads as workers are free as function(chunk, attempt), attempt is 0 for new chunk
+    (> 0 for retried words, their answer should not be taken from cache), result_handle(result) returns (words, error) -
+    words of chunk which were not found (failed request, broken answer, word missed in answer), only they are retried:
+        - they are packed to new chunks, chunk size is halved on every attempt (chunk_size >> attempt)
+        - word which failed max_attempts times goes to dead_letters with its last error
+    results are threads_run results: {'result': .., 'error': .., 'data': chunk}
+    """
+    def __init__(self, chunk_size=20, max_attempts=3):
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.queue = []
+        self.sequence = count()
+        self.attempts = {}
+        # attempt: failed words waiting to be packed to chunk
+        self.retry_words = {}
+        self.dead_letters = []
+
+    def __len__(self):
+        return len(self.queue) + sum(len(words) for words in self.retry_words.values())
+
+    def add(self, chunks: list, priority=new_priority):
+        for chunk in chunks:
+            if chunk:
+                heappush(self.queue, (priority, next(self.sequence), chunk))
+
+    def pop(self):
+        if not self.queue:
+            self.retry_flush(force=True)
+        return heappop(self.queue)[2] if self.queue else None
+
+    # not full chunks are queued only when there is nothing else to send (force), so retries are packed tighter
+    def retry_flush(self, force=False):
+        for attempt, words in self.retry_words.items():
+            size = max(self.chunk_size >> attempt, 1)
+            while len(words) >= size or (force and words):
+                self.add([words[:size]], priority=retry_priority)
+                del words[:size]
+        self.retry_words = {attempt: words for attempt, words in self.retry_words.items() if words}
+
+    def failed(self, words: list, error=None):
+        for word in words:
+            attempt = self.attempts.get(word['id'], 0) + 1
+            self.attempts[word['id']] = attempt
+            if attempt >= self.max_attempts:
+                last_error = str(error).strip().splitlines()[-1] if error else 'not found in answer'
+                self.dead_letters.append({'word': word['word'], 'attempts': attempt, 'error': last_error})
+                metrics.count('words_dead_letters')
+            else:
+                self.retry_words.setdefault(attempt, []).append(word)
+                metrics.count('words_retried')
+        self.retry_flush()
+
+    # failed attempts of words of chunk
+    def chunk_attempt(self, chunk):
+        return max(self.attempts.get(word['id'], 0) for word in chunk)
+
+    def result_process(self, result, result_handle):
+        failed_words, error = result_handle(result)
+        if failed_words:
+            self.failed(failed_words, error=error)
+
+    def run(self, function, result_handle, max_workers=5):
+        results = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            while True:
+                while len(futures) < max_workers:
+                    chunk = self.pop()
+                    if chunk is None:
+                        break
+                    futures[executor.submit(function, chunk, self.chunk_attempt(chunk))] = chunk
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = futures.pop(future)
+                    try:
+                        result = {'result': future.result(), 'error': None, 'data': chunk}
+                    except Exception as e:
+                        result = {'result': None, 'error': e, 'data': chunk}
+                    results.append(result)
+                    self.result_process(result, result_handle)
+        return results
+
+    # function - coroutine function, max_concurrency - max running coroutines
+    async def async_run(self, function, result_handle, max_concurrency=100):
+        results = []
+        tasks = {}
+        while True:
+            while len(tasks) < max_concurrency:
+                chunk = self.pop()
+                if chunk is None:
+                    break
+                tasks[asyncio.ensure_future(function(chunk, self.chunk_attempt(chunk)))] = chunk
+            if not tasks:
+                break
+
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                chunk = tasks.pop(task)
+                try:
+                    result = {'result': task.result(), 'error': None, 'data': chunk}
+                except Exception as e:
+                    result = {'result': None, 'error': e, 'data': chunk}
+                results.append(result)
+                self.result_process(result, result_handle)
+        return results
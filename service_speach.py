@@ -1,22 +1,156 @@
 from os import getenv
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 import xml.etree.ElementTree as xml_tree
 from subprocess import run as subprocess_run
+from threading import Lock, Timer
+from time import monotonic, time
+from json import dumps as json_dumps
+from json import loads as json_loads
+import asyncio
 
 
 load_dotenv()
 key = getenv("MS_SPEACH_KEY")
 region = getenv("MS_SPEACH_REGION")
 
+# token is valid for 10 minutes, it's refreshed a minute before
+token_lifetime = 9 * 60
+# seconds without issuing tries after failed one (requests are sent with key)
+token_failure_backoff = 60
+
+
+class TokenManager:
+    """
+    issues token once and gives the same token to all threads/coroutines till it expires
+    only one thread issues new token (others wait for it), while token is used it's refreshed in background
+    before expiry, so requests do not wait for issuing at all
+    if issuing fails, it's not tried again for failure_backoff seconds (get raises at once, callers use key)
+    """
+    def __init__(self, issue_func, lifetime=token_lifetime, background=True, failure_backoff=token_failure_backoff):
+        self.issue_func = issue_func
+        self.lifetime = lifetime
+        self.background = background
+        self.failure_backoff = failure_backoff
+        self.token = None
+        self.expires = 0
+        self.failed_until = 0
+        self.used = False
+        self.timer = None
+        self.lock = Lock()
+
+    def is_valid(self):
+        return self.token is not None and monotonic() < self.expires
+
+    def is_failed(self):
+        return monotonic() < self.failed_until
+
+    def get(self):
+        if not self.is_valid():
+            with self.lock:
+                if not self.is_valid():
+                    if self.is_failed():
+                        raise Exception('token issuing failed, next try after backoff')
+                    self.refresh()
+        self.used = True
+        return self.token
+
+    async def get_async(self):
+        if self.is_valid():
+            self.used = True
+            return self.token
+        return await asyncio.to_thread(self.get)
+
+    def refresh(self):
+        try:
+            token = self.issue_func()
+        except Exception:
+            self.failed_until = monotonic() + self.failure_backoff
+            raise
+        self.token = token
+        self.failed_until = 0
+        self.expires = monotonic() + self.lifetime
+        self.used = False
+        if self.background:
+            self.timer = Timer(self.lifetime * 0.9, self.refresh_background)
+            self.timer.daemon = True
+            self.timer.start()
+        return self.token
+
+    # token is not refreshed if it was not used since last refresh (no requests - no need to keep it)
+    def refresh_background(self):
+        with self.lock:
+            if self.used:
+                try:
+                    self.refresh()
+                except Exception:
+                    self.timer = None
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+
+# vocabulary languages are full names (f.e. "Spanish"), voices are selected by locale
+language_locales = {
+    'english': 'en-US',
+    'spanish': 'es-ES',
+    'russian': 'ru-RU',
+    'ukrainian': 'uk-UA',
+    'german': 'de-DE',
+    'french': 'fr-FR',
+    'italian': 'it-IT',
+    'portuguese': 'pt-PT',
+    'polish': 'pl-PL',
+}
+
+
+def locale_get(language):
+    if '-' in language:
+        return language
+    return language_locales.get(language.lower(), language.lower())
+
+
+# content types of recordings for speach_to_text (wav should be 16kHz mono pcm)
+audio_content_types = {
+    '.ogg': 'audio/ogg; codecs=opus',
+    '.opus': 'audio/ogg; codecs=opus',
+    '.wav': 'audio/wav; codecs=audio/pcm; samplerate=16000',
+}
+upload_chunk_size = 32 * 1024
+
+
+# generator of file parts, so file is uploaded (chunked transfer) without reading it to memory
+def file_chunks(file: Path, chunk_size=upload_chunk_size):
+    with file.open('rb') as file_data:
+        while chunk := file_data.read(chunk_size):
+            yield chunk
+
+
+# one manager per (token url, key), so all MSSpeach objects with the same key share token
+token_managers = {}
+token_managers_lock = Lock()
+
+
+def token_manager_get(issue_url, api_key, issue_func):
+    with token_managers_lock:
+        if (issue_url, api_key) not in token_managers:
+            token_managers[(issue_url, api_key)] = TokenManager(issue_func)
+        return token_managers[(issue_url, api_key)]
+
 
 # todo: think on flow, probably need to make a project for each language so no need to make tts if it already exists
 # get tanscriptions
 # https://eastus.dev.cognitive.microsoft.com/docs/services/speech-to-text-api-v3-1/operations/Transcriptions_List
 
 class MSSpeach:
-    def __init__(self, api_key=key, region=region):
+    # tts_api_url / stt_api_url / token_api_url - to use other server (f.e. local stub), by default azure urls of region
+    # use_token - requests are sent with shared token (see TokenManager) instead of key
+    def __init__(self, api_key=key, region=region, tts_api_url=None, stt_api_url=None, token_api_url=None,
+                 pool_size=20, use_token=True):
         self.api_key = api_key
         self.token = None
         self.region = region
@@ -25,83 +159,158 @@ class MSSpeach:
         self.tts_url = 'tts.speech.microsoft.com/cognitiveservices'
         self.stt_url = 'stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices'
         self.token_url = 'api.cognitive.microsoft.com/sts'
+        self.tts_api_url = tts_api_url if tts_api_url else f'https://{self.region}.{self.tts_url}'
+        self.stt_api_url = stt_api_url if stt_api_url else f'https://{self.region}.{self.stt_url}'
+        self.token_api_url = token_api_url if token_api_url else f'https://{self.region}.{self.token_url}'
+        # one keep-alive session for all requests, so batch synthesis does not open connection per text
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.token_manager = None
+        if use_token:
+            self.token_manager = token_manager_get(self.token_issue_url_get(), self.api_key, self.token_create)
 
     def make_request(self, method: str, url: str, params=None, headers=None, raw_data=None, data=None, files=None):
         method = method.lower()
 
-        if 'https' not in url:
-            api_url = f'https://{self.region}.tts.speech.microsoft.com/cognitiveservices'
+        if not url.startswith('http'):
             url = url[1:] if url.startswith('/') else url
-            url = f"{api_url}/{url}"
+            url = f"{self.tts_api_url}/{url}"
 
         if not headers:
             headers = {}
 
-        headers['Ocp-Apim-Subscription-Key'] = self.api_key
-        headers['Authorization'] = f'Bearer {self.token}'
+        # token is not used to issue token, key is used if token can not be issued
+        token = None
+        if self.token_manager and url != self.token_issue_url_get():
+            try:
+                token = self.token_manager.get()
+            except Exception:
+                token = None
+
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        else:
+            headers['Ocp-Apim-Subscription-Key'] = self.api_key
 
-        result = getattr(requests, method)(url, headers=headers, params=params, data=raw_data, json=data, files=files)
+        result = self.session.request(method, url, headers=headers, params=params, data=raw_data, json=data,
+                                      files=files)
         if result.status_code not in (200, 201):
             raise Exception(result.status_code, result.text)
 
-        if result.encoding:
+        # audio has no encoding, but apparent_encoding can be guessed for binary data as well
+        content_type = result.headers.get('Content-Type', '')
+        if 'json' in content_type:
             return result.json()
 
-        if result.apparent_encoding:
+        if content_type.startswith('text'):
             return result.text
 
         return result.content
 
-    def token_create(self):
+    def token_issue_url_get(self):
         api_version = f'v{self.api_ver_major}.{self.api_ver_minor}'
-        url = f'https://{self.region}.{self.token_url}/{api_version}/issueToken'
+        return f'{self.token_api_url}/{api_version}/issueToken'
+
+    def token_create(self):
+        url = self.token_issue_url_get()
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        return self.make_request('POST', url, headers=headers)
+        token = self.make_request('POST', url, headers=headers)
+        # token can come as application/jwt, make_request returns bytes for not text content types
+        if isinstance(token, bytes):
+            token = token.decode('utf-8')
+        self.token = token.strip()
+        return self.token
 
     def languages_get(self):
-        url = f'https://{self.region}.{self.tts_url}/voices/list'
+        url = f'{self.tts_api_url}/voices/list'
         return self.make_request('GET', url)
 
-    def text_to_speach(self, text, audio_format='ogg-48khz-16bit-mono-opus', file_location=''):
-        extension = audio_format.split('-')[-1]
-        url = f'https://{self.region}.{self.tts_url}/v{self.api_ver_major}'
-        headers = {
-                    'X-Microsoft-OutputFormat': audio_format,
-                    'Content-Type': 'application/ssml+xml',
-                  }
-
+    @staticmethod
+    def ssml_make(text, language='en-US', voice_name='en-US-ChristopherNeural', gender='Male'):
         speak = xml_tree.Element('speak')
         speak.set('version', '1.0')
-        speak.set('xml:lang', 'en-US')
+        speak.set('xml:lang', language)
 
         voice = xml_tree.SubElement(speak, 'voice')
-        voice.set('xml:lang', 'en-US')
-        voice.set('xml:gender', 'Male')
-        voice.set('name', 'en-US-ChristopherNeural')
+        voice.set('xml:lang', language)
+        voice.set('xml:gender', gender)
+        voice.set('name', voice_name)
         voice.text = text
 
         # todo: check with parameters can be added to voice (emotions, different pronunciation, speed,...)
         # https://github.com/MicrosoftDocs/azure-docs/blob/main/articles/cognitive-services/Speech-Service/speech-synthesis-markup.md
         # https://azure.microsoft.com/en-us/pricing/details/cognitive-services/speech-services/
 
-        data = xml_tree.tostring(speak, encoding='utf-8').decode()
+        return xml_tree.tostring(speak, encoding='utf-8').decode()
 
-        file_content = self.make_request('POST', url, headers=headers, raw_data=data)
+    # many texts in one document: every text starts with bookmark (its index) and is followed by break,
+    # so audio of one request can be split back to texts by silences (see audio_split.wav_split)
+    @staticmethod
+    def ssml_batch_make(texts: list, language='en-US', voice_name='en-US-ChristopherNeural', gender='Male',
+                        break_ms=1200):
+        speak = xml_tree.Element('speak')
+        speak.set('version', '1.0')
+        speak.set('xml:lang', language)
+
+        voice = xml_tree.SubElement(speak, 'voice')
+        voice.set('xml:lang', language)
+        voice.set('xml:gender', gender)
+        voice.set('name', voice_name)
+
+        for index, text in enumerate(texts):
+            bookmark = xml_tree.SubElement(voice, 'bookmark')
+            bookmark.set('mark', str(index))
+            bookmark.tail = text
+            if index < len(texts) - 1:
+                pause = xml_tree.SubElement(voice, 'break')
+                pause.set('time', f'{break_ms}ms')
+
+        return xml_tree.tostring(speak, encoding='utf-8').decode()
+
+    # returns audio content (bytes) of ssml document
+    def ssml_to_speach(self, ssml, audio_format='ogg-48khz-16bit-mono-opus'):
+        url = f'{self.tts_api_url}/v{self.api_ver_major}'
+        headers = {
+                    'X-Microsoft-OutputFormat': audio_format,
+                    'Content-Type': 'application/ssml+xml',
+                  }
+
+        file_content = self.make_request('POST', url, headers=headers, raw_data=ssml.encode('utf-8'))
 
         if not file_content:
             raise Exception('Failed to get audio content')
+        return file_content
+
+    # file_name - name of file without extension, text by default
+    def text_to_speach(self, text, audio_format='ogg-48khz-16bit-mono-opus', file_location='', file_name=None,
+                       language='en-US', voice_name='en-US-ChristopherNeural', gender='Male'):
+        extension = 'wav' if audio_format.startswith('riff') else audio_format.split('-')[-1]
+        data = self.ssml_make(text, language=language, voice_name=voice_name, gender=gender)
+        file_content = self.ssml_to_speach(data, audio_format=audio_format)
 
-        file = Path(file_location, f"{text}.{extension}")
+        file_name = file_name if file_name else text
+        file = Path(file_location, f"{file_name}.{extension}")
         file.write_bytes(file_content)
 
         return file
 
-    def speach_to_text(self, file, file_location='', language='en-US'):
-        url = f'https://{self.region}.{self.stt_url}/v{self.api_ver_major}'
-        headers = {'Content-Type': 'audio/ogg'}
+    # file - path of recording or generator of its bytes parts (f.e. from microphone)
+    # stream - file is sent by parts (chunked transfer), not read to memory as a whole
+    # content_type - by file extension if not set (see audio_content_types)
+    def speach_to_text(self, file, file_location='', language='en-US', content_type=None, stream=True,
+                       chunk_size=upload_chunk_size):
+        url = f'{self.stt_api_url}/v{self.api_ver_major}'
         params = {'language': language}
-        file = Path(file_location, file) if not isinstance(file, Path) else file
-        data = file.read_bytes()
+        if isinstance(file, (str, Path)):
+            file = Path(file_location, file) if not isinstance(file, Path) else file
+            content_type = content_type if content_type else audio_content_types.get(file.suffix.lower())
+            data = file_chunks(file, chunk_size) if stream else file.read_bytes()
+        else:
+            data = file
+
+        headers = {'Content-Type': content_type if content_type else 'audio/ogg'}
 
         return self.make_request('POST', url, headers=headers, raw_data=data, params=params)
 
@@ -128,3 +337,51 @@ class MSSpeach:
             command = [app_path, '/play', path]
             subprocess_run(command, shell=True)
 
+
+class VoiceCatalogue:
+    """
+    list of voices (MSSpeach.languages_get()) cached in json file for ttl seconds and indexed by locale,
+    so voice for every clip is selected locally, without request
+    """
+    def __init__(self, speach: MSSpeach = None, cache_file='.voices_cache.json', ttl=7 * 24 * 3600):
+        self.speach = speach
+        self.cache_file = Path(cache_file)
+        self.ttl = ttl
+        self.voices = None
+        self.by_locale = {}
+        self.by_language = {}
+
+    def voices_get(self, refresh=False):
+        if self.voices is not None and not refresh:
+            return self.voices
+
+        is_fresh = self.cache_file.exists() and time() - self.cache_file.stat().st_mtime < self.ttl
+        if is_fresh and not refresh:
+            self.voices = json_loads(self.cache_file.read_text(encoding='utf-8'))
+        else:
+            self.speach = self.speach if self.speach else MSSpeach()
+            self.voices = self.speach.languages_get()
+            self.cache_file.write_text(json_dumps(self.voices, ensure_ascii=False), encoding='utf-8')
+
+        self.by_locale = {}
+        self.by_language = {}
+        for voice in self.voices:
+            self.by_locale.setdefault(voice['Locale'].lower(), []).append(voice)
+            self.by_language.setdefault(voice['Locale'].split('-')[0].lower(), []).append(voice)
+        return self.voices
+
+    def voices_find(self, locale, gender=None, style=None):
+        self.voices_get()
+        voices = self.by_locale.get(locale.lower()) or self.by_language.get(locale.split('-')[0].lower(), [])
+        if gender:
+            voices = [voice for voice in voices if voice.get('Gender', '').lower() == gender.lower()]
+        if style:
+            voices = [voice for voice in voices if style in voice.get('StyleList', [])]
+        return voices
+
+    # language - name ("Spanish") or locale ("es-MX"), neural voices are preferred
+    def voice_select(self, language, gender=None, style=None):
+        voices = self.voices_find(locale_get(language), gender=gender, style=style)
+        if not voices:
+            raise Exception(f'no voice for language "{language}" (gender: {gender}, style: {style})')
+        return sorted(voices, key=lambda voice: 'Neural' not in voice['ShortName'])[0]
@@ -1,20 +1,49 @@
 from os import getenv
+from os import replace as os_replace
+from pathlib import Path
+from json import dumps as json_dumps
+from json import loads as json_loads
 from dotenv import load_dotenv
 import requests
+import extra_functions
 
 load_dotenv()
 key = getenv("MS_TRANSLATE_KEY")
 region = getenv("MS_TRANSLATE_REGION")
 
+# vocabulary languages are full names (f.e. "Spanish"), translator uses codes
+language_codes = {
+    'english': 'en',
+    'spanish': 'es',
+    'russian': 'ru',
+    'ukrainian': 'uk',
+    'german': 'de',
+    'french': 'fr',
+    'italian': 'it',
+    'portuguese': 'pt',
+    'polish': 'pl',
+}
+
+# translator limits for one request: elements in array and characters of all elements
+max_texts = 1000
+max_chars = 50000
+
+
+def language_code_get(language):
+    return language_codes.get(language.lower(), language.lower())
+
 
 class MSTranslate:
-    def __init__(self, api_key=key, region=region):
+    # api_url - to use other server (f.e. local stub), by default https://api.cognitive.microsofttranslator.com
+    def __init__(self, api_key=key, region=region, api_url=None):
         self.api_key = api_key
         self.token = None
         self.region = region
         self.api_ver_major = '3'
         self.api_ver_minor = '0'
         self.translate_url = 'api.cognitive.microsofttranslator.com'
+        self.api_url = api_url if api_url else f'https://{self.translate_url}'
+        self.session = requests.Session()
 
     def make_request(self, method: str, url: str, params=None, headers=None, raw_data=None, data=None, files=None):
         method = method.lower()
@@ -22,10 +51,9 @@ class MSTranslate:
             params = {}
         params['api-version'] = f'{self.api_ver_major}.{self.api_ver_minor}'
 
-        if 'https' not in url:
-            api_url = f'https://{self.translate_url}'
+        if not url.startswith('http'):
             url = url[1:] if url.startswith('/') else url
-            url = f"{api_url}/{url}"
+            url = f"{self.api_url}/{url}"
 
         if not headers:
             headers = {}
@@ -34,7 +62,8 @@ class MSTranslate:
         headers['Ocp-Apim-Subscription-Region'] = self.region
         # headers['Authorization'] = f'Bearer {self.token}'
 
-        result = getattr(requests, method)(url, headers=headers, params=params, data=raw_data, json=data, files=files)
+        result = self.session.request(method, url, headers=headers, params=params, data=raw_data, json=data,
+                                      files=files)
         if result.status_code not in (200, 201):
             raise Exception(result.status_code, result.text)
 
@@ -58,12 +87,112 @@ class MSTranslate:
         return self.make_request('GET', url)
 
     def translate(self, from_lang, to_lang, texts):
-        url = 'translate?api-version=3.0&from=en&to=ru'
+        url = '/translate'
         headers = {'Content-Type': 'application/json'}
         params = {
                     'from': from_lang,
-                    'to_lang': to_lang
+                    'to': to_lang
                  }
         texts = [texts] if not isinstance(texts, list) else texts
         data = [{'Text': text} for text in texts]
-        return self.make_request('POST', url, headers=headers, data=data, params=params)
\ No newline at end of file
+        return self.make_request('POST', url, headers=headers, data=data, params=params)
+
+
+class TranslationEngine:
+    """
+    translates many texts with MSTranslate: texts are deduplicated, already translated are taken from cache,
+    others are sent in batches (up to max_texts / max_chars per request) in threads
+        cache_file - json file with translations by "from|to|text", None - cache only in memory
+    """
+    def __init__(self, translator=None, cache_file='.translate_cache.json', max_workers=5,
+                 batch_texts=max_texts, batch_chars=max_chars):
+        self.translator = translator if translator else MSTranslate()
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.max_workers = max_workers
+        self.batch_texts = batch_texts
+        self.batch_chars = batch_chars
+        self.cache = {}
+        if self.cache_file and self.cache_file.exists():
+            self.cache = json_loads(self.cache_file.read_text(encoding='utf-8'))
+
+    @staticmethod
+    def cache_key(from_lang, to_lang, text):
+        return f'{from_lang}|{to_lang}|{text}'
+
+    def cache_save(self):
+        if not self.cache_file:
+            return None
+        temp_file = self.cache_file.with_suffix('.tmp')
+        temp_file.write_text(json_dumps(self.cache, ensure_ascii=False), encoding='utf-8')
+        os_replace(temp_file, self.cache_file)
+        return self.cache_file
+
+    def batches_make(self, texts: list):
+        batches = []
+        batch = []
+        batch_chars = 0
+        for text in texts:
+            if batch and (len(batch) >= self.batch_texts or batch_chars + len(text) > self.batch_chars):
+                batches.append(batch)
+                batch = []
+                batch_chars = 0
+            batch.append(text)
+            batch_chars += len(text)
+
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batch_translate(self, texts: list, from_lang, to_lang):
+        result = self.translator.translate(from_lang, to_lang, texts)
+        return {text: item['translations'][0]['text'] for text, item in zip(texts, result)}
+
+    # returns dict text: translation, texts which failed to translate are not in it
+    def translate(self, texts: list, from_lang, to_lang):
+        from_lang = language_code_get(from_lang)
+        to_lang = language_code_get(to_lang)
+        texts = list(dict.fromkeys(text for text in texts if text))
+
+        translations = {}
+        to_translate = []
+        for text in texts:
+            cached = self.cache.get(self.cache_key(from_lang, to_lang, text))
+            if cached is None:
+                to_translate.append(text)
+            else:
+                translations[text] = cached
+
+        if to_translate:
+            results = extra_functions.threads_run(self.batch_translate, self.batches_make(to_translate),
+                                                  [from_lang, to_lang], max_workers=self.max_workers)
+            for result in results:
+                if result['error']:
+                    continue
+                translations.update(result['result'])
+                for text, translation in result['result'].items():
+                    self.cache[self.cache_key(from_lang, to_lang, text)] = translation
+            self.cache_save()
+
+        return translations
+
+    # mode: fill - only empty translations are set, replace - all translations are set,
+    #       verify - translation is put to "<field>_verify" field, so it can be compared with GPT one
+    def fill_vocabulary(self, words: list, from_lang, to_lang, mode='fill',
+                        fields=(('whole_word', 'word_translation'), ('sentence', 'sentence_translation'))):
+        texts = []
+        for word in words:
+            for source_field, target_field in fields:
+                if mode != 'fill' or not word.get(target_field):
+                    texts.append(word.get(source_field))
+
+        translations = self.translate(texts, from_lang, to_lang)
+        for word in words:
+            for source_field, target_field in fields:
+                translation = translations.get(word.get(source_field))
+                if translation is None:
+                    continue
+                if mode == 'verify':
+                    word[f'{target_field}_verify'] = translation
+                elif mode == 'replace' or not word.get(target_field):
+                    word[target_field] = translation
+        return words
@@ -1,40 +1,105 @@
-from requests import get
+from requests import Session
 from bs4 import BeautifulSoup
 from re import compile as re_compile
 from re import search as re_search
 from json import loads as json_loads
+from json import dumps as json_dumps
+from json import JSONDecoder
+from hashlib import sha256
+from pathlib import Path
 from os import getenv
+from os import replace as os_replace
 from dotenv import load_dotenv
+import extra_functions
 
 
 load_dotenv()
 url = getenv('SP_DICT')
+cache_folder = Path(getenv('SP_DICT_CACHE', '.spanish_dict_cache'))
+session = Session()
+component_data_marker = 'window.SD_COMPONENT_DATA = '
+# vocab name: (id, slug), filled by vocabs_index_get()
+vocabs_index = {}
 
 
-def vocabs_get():
-    res = get(f'{url}/lists/categories')
-    soup = BeautifulSoup(res.text, 'html.parser')
+def cache_file_get(page_url):
+    return cache_folder.joinpath(f"{sha256(page_url.encode('utf-8')).hexdigest()}.json")
+
+
+# page is revalidated by ETag / Last-Modified of cached copy, so not changed page is not downloaded again
+def page_get(page_url, use_cache=True):
+    file = cache_file_get(page_url)
+    cached = json_loads(file.read_text(encoding='utf-8')) if use_cache and file.exists() else None
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    res = session.get(page_url, headers=headers)
+    if res.status_code == 304 and cached:
+        return cached['text']
+    res.raise_for_status()
+
+    if use_cache and (res.headers.get('ETag') or res.headers.get('Last-Modified')):
+        cache_folder.mkdir(parents=True, exist_ok=True)
+        temp_file = file.with_suffix('.tmp')
+        temp_file.write_text(json_dumps({'url': page_url, 'etag': res.headers.get('ETag'),
+                                         'last_modified': res.headers.get('Last-Modified'), 'text': res.text},
+                                        ensure_ascii=False), encoding='utf-8')
+        os_replace(temp_file, file)
+    return res.text
+
+
+def component_data_get_soup(html):
+    soup = BeautifulSoup(html, 'html.parser')
     script_tag = soup.find('script', string=re_compile(r'window\.SD_COMPONENT_DATA'))
     data_str = re_search(r'window\.SD_COMPONENT_DATA = (.+);', script_tag.text).group(1)
-    data = json_loads(data_str)
+    return json_loads(data_str)
+
+
+# json is decoded right from the page text, without building DOM (soup is used if page has other format)
+def component_data_get(html):
+    start = html.find(component_data_marker)
+    if start == -1:
+        return component_data_get_soup(html)
+    try:
+        return JSONDecoder().raw_decode(html, start + len(component_data_marker))[0]
+    except ValueError:
+        return component_data_get_soup(html)
+
+
+def vocabs_get(use_cache=True):
+    data = component_data_get(page_get(f'{url}/lists/categories', use_cache=use_cache))
     return data.get('vocabLists')
 
 
+def vocabs_index_get(refresh=False):
+    if refresh or not vocabs_index:
+        vocabs_index.clear()
+        vocabs_index.update({vocab.get('name'): (vocab['id'], vocab['slug']) for vocab in vocabs_get()})
+    return vocabs_index
+
+
 def vocabs_filter_big(vocabs: list, min_words=500):
     return list(filter(lambda x: x['numVocabTranslations'] > min_words, vocabs))
 
 
-def vocab_content_get(vocab_id, vocab_slug):
-    res = get(f'{url}/lists/{vocab_id}/{vocab_slug}')
-    soup = BeautifulSoup(res.text, 'html.parser')
-    script_tag = soup.find('script', string=re_compile(r'window\.SD_COMPONENT_DATA'))
-    data_str = re_search(r'window\.SD_COMPONENT_DATA = (.+);', script_tag.text).group(1)
-    data = json_loads(data_str)
+def vocab_content_get(vocab_id, vocab_slug, use_cache=True):
+    data = component_data_get(page_get(f'{url}/lists/{vocab_id}/{vocab_slug}', use_cache=use_cache))
     words = data.get('words')
     return [word['source'] for word in words]
 
 
 def vocab_content_by_name(vocab_name):
-    vocabs = vocabs_get()
-    vocab = [vocab for vocab in vocabs if vocab.get('name') == vocab_name][0]
-    return vocab_content_get(vocab['id'], vocab['slug'])
\ No newline at end of file
+    vocab_id, vocab_slug = vocabs_index_get()[vocab_name]
+    return vocab_content_get(vocab_id, vocab_slug)
+
+
+# words of many lists, lists are downloaded in threads, returns dict name: words
+def vocabs_content_by_names(vocab_names: list, max_workers=10):
+    index = vocabs_index_get()
+    results = extra_functions.threads_run(lambda name: vocab_content_get(*index[name]), vocab_names,
+                                          max_workers=max_workers)
+    return {result['data']: result['result'] for result in results if not result['error']}
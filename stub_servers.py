@@ -0,0 +1,325 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from random import Random
+from ast import literal_eval
+from time import sleep, time
+from json import dumps as json_dumps
+from json import loads as json_loads
+from urllib.parse import urlparse, parse_qs
+from array import array
+from math import sin, pi
+from io import BytesIO
+import wave
+from zlib import crc32
+import service_translate
+
+# local stand-ins of external services, to run the pipeline without network and money
+# usage:
+#   python stub_servers.py chat --port 8765 --latency 0.5    (and GPT_BACKEND=mock for gpt_helper)
+#   server, url = server_start(TranslateStubHandler)
+#   engine = TranslationEngine(MSTranslate(api_key='stub', region='stub', api_url=url), cache_file=None)
+#   ...
+#   server.shutdown()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def body_get(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def reply(self, status, data=None, content_type='application/json; charset=utf-8', raw_data=None):
+        body = raw_data if raw_data is not None else json_dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# translation is "<to>:<text>", limits of real api are checked, so batching errors are visible
+class TranslateStubHandler(StubHandler):
+    requests_count = 0
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path != '/translate' or not params.get('to'):
+            return self.reply(400, {'error': {'code': 400000, 'message': 'wrong path or "to" parameter'}})
+
+        texts = [item['Text'] for item in json_loads(self.body_get())]
+        if len(texts) > service_translate.max_texts or sum(len(text) for text in texts) > service_translate.max_chars:
+            return self.reply(400, {'error': {'code': 400077, 'message': 'request is too big'}})
+
+        TranslateStubHandler.requests_count += 1
+        to_lang = params['to'][0]
+        self.reply(200, [{'translations': [{'text': f'{to_lang}:{text}', 'to': to_lang}]} for text in texts])
+
+
+# MSSpeach urls: tts_api_url=f'{url}/cognitiveservices', token_api_url=f'{url}/sts',
+#                stt_api_url=f'{url}/speech/recognition/conversation/cognitiveservices'
+# audio is fake bytes with ssml inside (or wav with tones for riff formats)
+# token_content_type - content type of issued token, last_authorization - Authorization header of last synthesis
+class SpeachStubHandler(StubHandler):
+    requests_count = 0
+    tokens_count = 0
+    token_content_type = 'text/plain'
+    # not 200 - issueToken fails with it (requests with key still work)
+    token_status = 200
+    last_authorization = None
+    voices = [
+        {'ShortName': 'en-US-ChristopherNeural', 'Locale': 'en-US', 'Gender': 'Male', 'StyleList': []},
+        {'ShortName': 'es-ES-AlvaroNeural', 'Locale': 'es-ES', 'Gender': 'Male', 'StyleList': []},
+        {'ShortName': 'es-ES-ElviraNeural', 'Locale': 'es-ES', 'Gender': 'Female', 'StyleList': ['cheerful']},
+        {'ShortName': 'ru-RU-DmitryNeural', 'Locale': 'ru-RU', 'Gender': 'Male', 'StyleList': []},
+        {'ShortName': 'ru-RU-SvetlanaNeural', 'Locale': 'ru-RU', 'Gender': 'Female', 'StyleList': []},
+    ]
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/cognitiveservices/voices/list':
+            return self.reply(404, {'error': 'not found'})
+        self.reply(200, self.voices)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == '/sts/v1.0/issueToken':
+            SpeachStubHandler.tokens_count += 1
+            if self.token_status != 200:
+                return self.reply(self.token_status, {'error': 'token is not issued'})
+            return self.reply(200, raw_data=f'token-{self.tokens_count}'.encode(),
+                              content_type=self.token_content_type)
+
+        # recognized text is content of recording (utf-8 text), so tests can record "what was said"
+        if path == '/speech/recognition/conversation/cognitiveservices/v1':
+            text = self.body_get().decode('utf-8', errors='ignore')
+            return self.reply(200, {'RecognitionStatus': 'Success', 'DisplayText': text, 'Offset': 0, 'Duration': 0})
+
+        if path != '/cognitiveservices/v1':
+            return self.reply(404, {'error': 'not found'})
+        if not self.headers.get('Authorization') and not self.headers.get('Ocp-Apim-Subscription-Key'):
+            return self.reply(401, {'error': 'no token or key'})
+        SpeachStubHandler.requests_count += 1
+        SpeachStubHandler.last_authorization = self.headers.get('Authorization')
+        body = self.body_get()
+        if self.headers.get('X-Microsoft-OutputFormat', '').startswith('riff'):
+            return self.reply(200, raw_data=self.wav_make(max(body.count(b'<bookmark'), 1)), content_type='audio/wav')
+        self.reply(200, raw_data=b'AUDIO:' + body, content_type='audio/mpeg')
+
+    # tone of 300ms for every text with 1200ms silence (batch break) between them
+    @staticmethod
+    def wav_make(parts, frame_rate=24000):
+        tone = array('h', [int(8000 * sin(2 * pi * 440 * i / frame_rate)) for i in range(frame_rate * 3 // 10)])
+        silence = array('h', [0] * (frame_rate * 12 // 10))
+        samples = array('h')
+        for part in range(parts):
+            samples += tone + (silence if part < parts - 1 else array('h'))
+
+        data = BytesIO()
+        with wave.open(data, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(frame_rate)
+            wav_file.writeframes(samples.tobytes())
+        return data.getvalue()
+
+
+# spanish_dict.url should be set to url of server, lists have words "palabra <list id>-<index>"
+class SpanishDictStubHandler(StubHandler):
+    requests_count = 0
+    lists = {1: ('Beginner', 'beginner', 1000), 2: ('Food', 'food', 200), 3: ('Travel', 'travel', 300)}
+
+    def html_reply(self, data):
+        body = f'<html><head><script>window.SD_COMPONENT_DATA = {json_dumps(data, ensure_ascii=False)};</script>' \
+               f'</head><body></body></html>'.encode('utf-8')
+        etag = f'"{crc32(body)}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        SpanishDictStubHandler.requests_count += 1
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if parts == ['lists', 'categories']:
+            return self.html_reply({'vocabLists': [{'id': list_id, 'name': name, 'slug': slug,
+                                                    'numVocabTranslations': size}
+                                                   for list_id, (name, slug, size) in self.lists.items()]})
+
+        if len(parts) == 3 and parts[0] == 'lists' and parts[1].isdigit() and int(parts[1]) in self.lists:
+            size = self.lists[int(parts[1])][2]
+            return self.html_reply({'words': [{'source': f'palabra {parts[1]}-{index}'} for index in range(size)]})
+        self.reply(404, {'error': 'not found'})
+
+
+# chat completions mock (openai format), reply is json list of word dicts for words of the request
+# configure() sets latency (seconds), rates (0..1) of 429 and malformed json replies and seed of randomness
+# "stream": true - reply is sent as server-sent events by stream_part_size characters, latency is spread over them
+class ChatStubHandler(StubHandler):
+    requests_count = 0
+    latency = 0.0
+    rate_429 = 0.0
+    rate_malformed = 0.0
+    retry_after_ms = 100
+    stream_part_size = 40
+    random = Random(0)
+    lock = Lock()
+
+    @classmethod
+    def configure(cls, latency=0.0, rate_429=0.0, rate_malformed=0.0, retry_after_ms=100, seed=0):
+        cls.latency = latency
+        cls.rate_429 = rate_429
+        cls.rate_malformed = rate_malformed
+        cls.retry_after_ms = retry_after_ms
+        cls.random = Random(seed)
+        cls.requests_count = 0
+
+    # words are python list of dicts at the end of request (see Vocabulary.chunk_send)
+    @staticmethod
+    def words_get(content):
+        try:
+            words = literal_eval(content[content.rindex('\n') + 1:])
+        except (ValueError, SyntaxError):
+            return []
+        return words if isinstance(words, list) else []
+
+    @staticmethod
+    def word_make(word):
+        text = word.get('word', '') if isinstance(word, dict) else str(word)
+        return {
+                    'id': word.get('id') if isinstance(word, dict) else None,
+                    'word': text,
+                    'whole_word': text,
+                    'word_translation': f'перевод {text}',
+                    'sentence': f'Esta es la frase con {text}.',
+                    'sentence_translation': f'Это фраза с {text}.',
+                    'type': 'noun',
+                    'is_irregular': False,
+                    'level': 'A1',
+                    'language': 'spanish',
+                    'to_language': 'russian',
+                    'topics': 'mock, test',
+                    'source': 'mock, mock',
+               }
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/v1/chat/completions':
+            return self.reply(404, {'error': 'not found'})
+        request = json_loads(self.body_get())
+        with self.lock:
+            ChatStubHandler.requests_count += 1
+            is_429 = self.random.random() < self.rate_429
+            is_malformed = self.random.random() < self.rate_malformed
+        if self.latency and not request.get('stream'):
+            sleep(self.latency)
+
+        if is_429:
+            self.send_response(429)
+            self.send_header('retry-after-ms', str(self.retry_after_ms))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        content = request['messages'][-1]['content']
+        message = json_dumps([self.word_make(word) for word in self.words_get(content)], ensure_ascii=False)
+        if is_malformed:
+            message = message[:len(message) // 2]
+        usage = {'prompt_tokens': len(content) // 4, 'completion_tokens': len(message) // 4,
+                 'total_tokens': (len(content) + len(message)) // 4}
+        if request.get('stream'):
+            return self.stream_reply(request, message, usage)
+
+        self.reply(200, {
+                            'id': f'chatcmpl-{self.requests_count}',
+                            'object': 'chat.completion',
+                            'created': int(time()),
+                            'model': request.get('model', 'mock'),
+                            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': message},
+                                         'finish_reason': 'stop'}],
+                            'usage': usage,
+                        })
+
+    def stream_reply(self, request, message, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        event = {'id': f'chatcmpl-{self.requests_count}', 'object': 'chat.completion.chunk', 'created': int(time()),
+                 'model': request.get('model', 'mock')}
+        parts = [message[index: index + self.stream_part_size]
+                 for index in range(0, len(message), self.stream_part_size)]
+        for part in parts:
+            if self.latency:
+                sleep(self.latency / len(parts))
+            choice = {'index': 0, 'delta': {'content': part}, 'finish_reason': None}
+            self.event_send(dict(event, choices=[choice]))
+        self.event_send(dict(event, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            self.event_send(dict(event, choices=[], usage=usage))
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def event_send(self, data):
+        self.wfile.write(f'data: {json_dumps(data, ensure_ascii=False)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+# port=0 - any free port, returns server (call server.shutdown() to stop) and its url
+# f.e. chat mock for gpt_helper: server_start(ChatStubHandler, port=8765) and GPT_BACKEND=mock
+def server_start(handler, host='127.0.0.1', port=0):
+    server = StubServer((host, port), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+handlers = {'chat': ChatStubHandler, 'translate': TranslateStubHandler, 'speach': SpeachStubHandler,
+            'spanish_dict': SpanishDictStubHandler}
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='local stand-in of external service, runs until it is stopped (Ctrl+C)')
+    parser.add_argument('service', choices=handlers)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='chat: seconds of every reply')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='chat: part of requests answered with 429')
+    parser.add_argument('--rate-malformed', type=float, default=0.0, help='chat: part of replies with broken json')
+    parser.add_argument('--retry-after-ms', type=int, default=100, help='chat: retry-after-ms header of 429')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.service == 'chat':
+        ChatStubHandler.configure(latency=args.latency, rate_429=args.rate_429, rate_malformed=args.rate_malformed,
+                                  retry_after_ms=args.retry_after_ms, seed=args.seed)
+    server = StubServer((args.host, args.port), handlers[args.service])
+    print(f'{args.service} stub on http://{args.host}:{server.server_address[1]}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,615 @@
+from time import sleep, perf_counter
+import asyncio
+import sys
+from subprocess import Popen, PIPE
+from json import dumps as json_dumps
+from json import loads as json_loads
+from pathlib import Path
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+import pytest
+import stub_servers
+import service_translate
+import spanish_dict
+import gpt_helper
+import gpt_lang
+from gpt_cache import ResponseCache
+from service_translate import MSTranslate, TranslationEngine
+from json_stream import JSONArrayParser, array_items
+from journal import Journal
+import audio_split
+from audio_split import wav_split
+import vocabulary_audio
+from service_speach import MSSpeach
+from work_queue import WorkQueue
+from words_formatter import Vocabulary, create_vocabulary
+from post_process import PostProcessor
+from metrics import metrics
+from lexicon import Lexicon
+from audio_store import AudioStore
+from rate_limiter import RateLimiter, TokenBucket, duration_parse, retry_after_get
+from word_entry import WordEntry
+
+# behaviour checks which run without network and keys (local stub servers, temp folders): python -m pytest -q
+# tests.py has manual runs against live services
+fixtures_folder = Path(__file__).parent.joinpath('fixtures')
+
+
+@pytest.fixture
+def translate_server():
+    server, url = stub_servers.server_start(stub_servers.TranslateStubHandler)
+    stub_servers.TranslateStubHandler.requests_count = 0
+    yield url
+    server.shutdown()
+
+
+def test_translation_batches_fit_api_limits(translate_server):
+    engine = TranslationEngine(MSTranslate(api_key='stub', region='stub', api_url=translate_server), cache_file=None)
+    texts = [f'palabra {index}' for index in range(service_translate.max_texts * 2 + 10)]
+    translations = engine.translate(texts, 'Spanish', 'Russian')
+
+    assert len(translations) == len(texts)
+    assert translations['palabra 7'] == 'ru:palabra 7'
+    # stub rejects requests over max_texts / max_chars, so 3 successful requests mean batches were split right
+    assert stub_servers.TranslateStubHandler.requests_count == 3
+
+
+def test_translation_batches_split_by_chars():
+    engine = TranslationEngine(translator=object(), cache_file=None, batch_texts=100, batch_chars=10)
+    batches = engine.batches_make(['aaaa', 'bbbb', 'cccc', 'dddddddddddd', 'e'])
+    assert batches == [['aaaa', 'bbbb'], ['cccc'], ['dddddddddddd'], ['e']]
+
+
+def test_translation_cache(translate_server, tmp_path):
+    cache_file = tmp_path / 'translate_cache.json'
+    engine = TranslationEngine(MSTranslate(api_key='stub', region='stub', api_url=translate_server),
+                               cache_file=cache_file)
+    engine.translate(['casa', 'perro', 'casa'], 'es', 'ru')
+    assert stub_servers.TranslateStubHandler.requests_count == 1
+
+    # new engine reads cache file, only new text is sent
+    engine = TranslationEngine(MSTranslate(api_key='stub', region='stub', api_url=translate_server),
+                               cache_file=cache_file)
+    assert engine.translate(['casa', 'perro'], 'es', 'ru') == {'casa': 'ru:casa', 'perro': 'ru:perro'}
+    assert stub_servers.TranslateStubHandler.requests_count == 1
+    engine.translate(['casa', 'gato'], 'es', 'ru')
+    assert stub_servers.TranslateStubHandler.requests_count == 2
+
+
+def test_translation_fill_modes(translate_server):
+    engine = TranslationEngine(MSTranslate(api_key='stub', region='stub', api_url=translate_server), cache_file=None)
+    words = [{'whole_word': 'la casa', 'word_translation': 'дом', 'sentence': 'Mi casa.', 'sentence_translation': ''}]
+    engine.fill_vocabulary(words, 'Spanish', 'Russian', mode='fill')
+    assert words[0]['word_translation'] == 'дом'
+    assert words[0]['sentence_translation'] == 'ru:Mi casa.'
+
+    engine.fill_vocabulary(words, 'Spanish', 'Russian', mode='verify')
+    assert words[0]['word_translation'] == 'дом'
+    assert words[0]['word_translation_verify'] == 'ru:la casa'
+
+
+def test_rate_limit_durations():
+    assert duration_parse('6m0s') == 360
+    assert duration_parse('1.5s') == 1.5 and duration_parse('20ms') == 0.02 and duration_parse('0.5') == 0.5
+    assert duration_parse('soon') is None and duration_parse(None) is None
+
+    assert retry_after_get({'retry-after-ms': '250', 'Retry-After': '3'}) == 0.25
+    assert retry_after_get({'Retry-After': '3'}) == 3
+    assert retry_after_get({}) is None
+    retry_date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < retry_after_get({'Retry-After': retry_date}) <= 30
+    assert retry_after_get({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 0
+
+
+def test_rate_limiter_pause_blocks_acquire():
+    limiter = RateLimiter()
+    assert limiter.try_acquire() == 0
+    limiter.pause(0.2)
+    assert 0.1 < limiter.try_acquire() <= 0.2
+    waited = limiter.acquire()
+    assert waited >= 0.1 and limiter.stats()['throttled_count'] == 1
+
+
+def test_token_bucket_wait_time():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=600)
+    assert limiter.try_acquire(tokens=590) == 0
+    # 10 tokens left, 10 tokens per second are refilled
+    assert 0.9 < limiter.try_acquire(tokens=20) <= 1
+
+    bucket = TokenBucket(60)
+    bucket.value = 0
+    assert bucket.wait_time(2) == 2
+    # request bigger than capacity waits for full bucket
+    assert bucket.wait_time(100) == 60
+
+
+def test_json_array_parser_by_parts():
+    text = 'Here is the list: [{"id": 0, "word": "a]b"}, {"id": 1, "word": "c\\"d"}, {"id": 2, "wo'
+    parser = JSONArrayParser()
+    items = []
+    for index in range(0, len(text), 7):
+        items += parser.feed(text[index: index + 7])
+    assert items == [{'id': 0, 'word': 'a]b'}, {'id': 1, 'word': 'c"d'}]
+    assert not parser.finished
+
+
+def test_json_array_parser_skips_broken_items():
+    items = array_items('[{"id": 0}, {"id": 1,, }, {"id": 2}] {"id": 3}')
+    assert items == [{'id': 0}, {'id': 2}]
+
+
+def test_journal_skips_torn_line(tmp_path):
+    journal = Journal(tmp_path / 'vocab.journal.jsonl')
+    journal.append([{'word': 'casa'}, {'word': 'perro'}])
+    journal.append([{'word': 'Casa', 'level': 'A2'}])
+    journal.close()
+    with journal.file.open('a', encoding='utf-8') as file_data:
+        file_data.write('{"word": "ga')
+
+    assert len(journal.read()) == 3
+    assert journal.compact() == [{'word': 'Casa', 'level': 'A2'}, {'word': 'perro'}]
+
+
+def test_wav_split():
+    content = stub_servers.SpeachStubHandler.wav_make(3)
+    parts = wav_split(content, 3)
+    assert len(parts) == 3
+    assert all(part.startswith(b'RIFF') for part in parts)
+    assert wav_split(content, 4) is None
+
+
+def test_work_queue_lease_expiry(tmp_path):
+    work_queue = WorkQueue(tmp_path / 'queue.sqlite', max_attempts=2)
+    work_queue.put('vocab', [{'words': ['casa']}])
+    first = work_queue.lease('vocab', timeout=0.05)[0]
+    assert work_queue.lease('vocab') == []
+
+    # worker of first lease "crashed", item is given to next worker
+    sleep(0.1)
+    second = work_queue.lease('vocab', timeout=0.05)[0]
+    assert second['id'] == first['id'] and second['attempts'] == 2
+    assert not work_queue.extend(first['id'], first['lease'])
+
+    # max_attempts leases expired, item is dead
+    sleep(0.1)
+    assert work_queue.lease('vocab') == []
+    assert work_queue.stats('vocab')['dead'] == 1
+
+
+def test_work_queue_commit_is_idempotent(tmp_path):
+    work_queue = WorkQueue(tmp_path / 'queue.sqlite')
+    work_queue.put('vocab', [{'words': ['casa', 'perro']}])
+    first = work_queue.lease('vocab', timeout=0.05)[0]
+    sleep(0.1)
+    second = work_queue.lease('vocab')[0]
+
+    assert work_queue.commit(second['id'], second['lease'], result=['second'],
+                             new_items=[([{'words': ['perro']}], 0, 'ready', None)])
+    # late commit of expired lease does not replace result and does not add items again
+    assert not work_queue.commit(first['id'], first['lease'], result=['first'],
+                                 new_items=[([{'words': ['perro']}], 0, 'ready', None)])
+    assert [item['result'] for item in work_queue.items_get('vocab')] == [['second']]
+    assert work_queue.stats('vocab')['ready'] == 1
+
+
+def test_words_merge_policies():
+    old = [{'word': 'casa', 'whole_word': 'la casa', 'level': 'A1', 'sentence': ''}]
+    new = [{'word': 'casa', 'whole_word': 'La Casa', 'level': 'A2', 'sentence': 'Mi casa.'},
+           {'word': 'perro', 'whole_word': 'el perro', 'level': 'A1'}]
+
+    merged = Vocabulary.words_merge([old, new], policy='keep_first')
+    assert [(word['whole_word'], word['level'], word['sentence']) for word in merged[:1]] == [('la casa', 'A1', '')]
+    assert len(merged) == 2
+
+    merged = Vocabulary.words_merge([old, new], policy='keep_newest')
+    assert (merged[0]['level'], merged[0]['sentence']) == ('A2', 'Mi casa.')
+
+    merged = Vocabulary.words_merge([old, new], policy='fill')
+    assert (merged[0]['level'], merged[0]['sentence']) == ('A1', 'Mi casa.')
+
+    with pytest.raises(Exception):
+        Vocabulary.words_merge([old, new], policy='newest')
+
+
+class AnswersBackend(gpt_helper.ChatBackend):
+    """chat backend which replies with given messages in turn (the last one is repeated)"""
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.calls = 0
+
+    def send(self, messages: list, on_delta=None):
+        message = self.messages[min(self.calls, len(self.messages) - 1)]
+        self.calls += 1
+        return gpt_helper.message_deliver({'success': True, 'status_code': 200, 'attempts': 1, 'data': {
+            'id': f'answer-{self.calls}', 'model': self.model, 'created': 0,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': message}, 'finish_reason': 'stop'}],
+            'usage': {'total_tokens': 10}}}, on_delta)
+
+
+class WordsBackend(gpt_helper.ChatBackend):
+    """chat backend which answers with words of request as mock server does, words of skip are left out once"""
+    def __init__(self, skip=()):
+        self.skip = set(skip)
+        self.calls = 0
+        self.streamed = 0
+        self.requested = []
+
+    def send(self, messages: list, on_delta=None):
+        self.calls += 1
+        self.streamed += bool(on_delta)
+        words = stub_servers.ChatStubHandler.words_get(messages[-1]['content'])
+        self.requested += [word['word'] for word in words]
+        skipped = {word['word'] for word in words} & self.skip
+        self.skip -= skipped
+        message = json_dumps([stub_servers.ChatStubHandler.word_make(word) for word in words
+                              if word['word'] not in skipped], ensure_ascii=False)
+        return gpt_helper.message_deliver({'success': True, 'status_code': 200, 'attempts': 1, 'data': {
+            'id': f'answer-{self.calls}', 'model': self.model, 'created': 0,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': message}, 'finish_reason': 'stop'}],
+            'usage': {'total_tokens': 10}}}, on_delta)
+
+
+@pytest.fixture
+def chat_server(gpt_cache):
+    server, url = stub_servers.server_start(stub_servers.ChatStubHandler)
+    stub_servers.ChatStubHandler.configure()
+    gpt_helper.set_backend(gpt_helper.OpenAIBackend(url=f'{url}/v1/chat/completions', api_token='stub'))
+    yield url
+    stub_servers.ChatStubHandler.configure()
+    server.shutdown()
+
+
+@pytest.fixture
+def gpt_cache(monkeypatch, tmp_path):
+    cache = ResponseCache(folder=tmp_path / 'gpt_cache')
+    monkeypatch.setattr(gpt_helper, 'cache', cache)
+    yield cache
+    gpt_helper.set_backend(None)
+
+
+def test_gpt_cache_keeps_only_valid_answers(gpt_cache):
+    backend = gpt_helper.set_backend(AnswersBackend(['[{"id": 0, "word": "ca', '[{"id": 0, "word": "casa"}]']))
+    assert not gpt_helper.send_question('casa', cache_check=gpt_lang.answer_check)['cached']
+    # broken answer was not cached, so it is requested again
+    result = gpt_helper.send_question('casa', cache_check=gpt_lang.answer_check)
+    assert not result['cached'] and backend.calls == 2
+    assert gpt_helper.send_question('casa', cache_check=gpt_lang.answer_check)['cached']
+
+    assert gpt_cache.delete(result['cache_key'])
+    assert not gpt_helper.send_question('casa')['cached'] and backend.calls == 3
+
+
+def test_gpt_cache_entries_count(tmp_path):
+    cache = ResponseCache(folder=tmp_path / 'gpt_cache', max_entries=3)
+    for _ in range(5):
+        cache.set('aa01', {'answer': 1})
+    cache.set('aa02', {'answer': 2})
+    cache.set('aa03', {'answer': 3})
+    # overwritten entry is counted once, so nothing is evicted yet
+    assert cache.entries == 3 and cache.get('aa01') == {'answer': 1}
+    cache.delete('aa03')
+    assert cache.entries == 2 and cache.get('aa03') is None
+
+
+@pytest.fixture
+def spanish_dict_server(monkeypatch, tmp_path):
+    server, url = stub_servers.server_start(stub_servers.SpanishDictStubHandler)
+    monkeypatch.setattr(spanish_dict, 'url', url)
+    monkeypatch.setattr(spanish_dict, 'cache_folder', tmp_path / 'spanish_dict_cache')
+    yield url
+    server.shutdown()
+
+
+def test_spanish_dict_component_data():
+    html = fixtures_folder.joinpath('spanish_dict_list.html').read_text(encoding='utf-8')
+    data = spanish_dict.component_data_get(html)
+    assert data['list']['slug'] == 'beginner'
+    assert [word['source'] for word in data['words']] == ['el artista', 'pagar', '¿Por qué no entras?', 'la cama']
+    assert data == spanish_dict.component_data_get_soup(html)
+
+
+def test_spanish_dict_component_data_soup_fallback():
+    html = fixtures_folder.joinpath('spanish_dict_list.html').read_text(encoding='utf-8')
+    # first marker is not followed by json, so data is taken from script tag by soup
+    html = html.replace('<head>', '<head>\n<!-- window.SD_COMPONENT_DATA = is set by server -->', 1)
+    data = spanish_dict.component_data_get(html)
+    assert data['words'][3]['tags'] == ['</div>', '};']
+
+
+def test_spanish_dict_page_revalidation(spanish_dict_server):
+    words = spanish_dict.vocab_content_get(2, 'food')
+    assert len(words) == 200 and words[0] == 'palabra 2-0'
+
+    # not changed page is answered with 304, so text of cached copy is used
+    cache_file = spanish_dict.cache_file_get(f'{spanish_dict_server}/lists/2/food')
+    cache_file.write_text(cache_file.read_text(encoding='utf-8').replace('palabra 2-0', 'cached 2-0'),
+                          encoding='utf-8')
+    assert spanish_dict.vocab_content_get(2, 'food')[0] == 'cached 2-0'
+    assert spanish_dict.vocab_content_get(2, 'food', use_cache=False)[0] == 'palabra 2-0'
+
+
+def test_metrics_export_includes_run(gpt_cache, tmp_path):
+    gpt_helper.set_backend(WordsBackend())
+    metrics.reset()
+    metrics_file = tmp_path / 'metrics.prom'
+    vocabulary = Vocabulary('spanish', 'russian', folder=str(tmp_path), chunks_size=2, metrics_file=metrics_file)
+    result = vocabulary.add_new_words(['casa', 'perro', 'gato'])
+
+    lines = metrics_file.read_text(encoding='utf-8').splitlines()
+    assert '# TYPE language_helper_words_added counter' in lines and 'language_helper_words_added 3' in lines
+    assert 'language_helper_gpt_requests 2' in lines
+    assert '# TYPE language_helper_add_new_words_seconds summary' in lines
+    assert 'language_helper_add_new_words_seconds_count 1' in lines
+    assert any(line.startswith('language_helper_add_new_words_seconds_max ') for line in lines)
+    assert result['metrics']['timers']['add_new_words_seconds']['count'] == 1
+
+    vocabulary.metrics_file = tmp_path / 'metrics.json'
+    vocabulary.add_new_words(['gato', 'mesa'])
+    summary = json_loads(vocabulary.metrics_file.read_text(encoding='utf-8'))
+    assert summary['timers']['add_new_words_seconds']['count'] == 2 and summary['counters']['words_added'] == 4
+
+
+def test_async_post_processor_is_not_streamed(gpt_cache, tmp_path):
+    backend = gpt_helper.set_backend(WordsBackend())
+    with PostProcessor(max_workers=1) as post_processor:
+        vocabulary = Vocabulary('spanish', 'russian', folder=str(tmp_path), chunks_size=5, post_processor=post_processor)
+        result = vocabulary.add_new_words([f'palabra {index}' for index in range(12)], use_async=True)
+    assert result['success'] and len(result['added_words']) == 12
+    assert backend.calls == 3 and not backend.streamed
+    assert all(item['result']['saved'] and 'parse_errors' not in item['result'] for item in result['thread_results'])
+
+
+def test_async_requests_are_not_limited_by_threads(chat_server, tmp_path, monkeypatch):
+    stub_servers.ChatStubHandler.configure(latency=0.5)
+    # blocking session (threads) is not used
+    monkeypatch.setattr(gpt_helper, 'session', None)
+    vocabulary = Vocabulary('spanish', 'russian', folder=str(tmp_path), chunks_size=1, threads_workers=1,
+                            concurrency=40)
+    start = perf_counter()
+    result = vocabulary.add_new_words([f'palabra {index}' for index in range(40)], use_async=True)
+    # 40 requests of 0.5s are in work at once
+    assert perf_counter() - start < 3
+    assert result['success'] and len(result['added_words']) == 40
+    assert stub_servers.ChatStubHandler.requests_count == 40
+
+
+def test_async_stream_and_retries(chat_server, tmp_path, monkeypatch):
+    stub_servers.ChatStubHandler.configure(rate_429=0.3, retry_after_ms=10, seed=1)
+    monkeypatch.setattr(gpt_helper, 'limiter', gpt_helper.RateLimiter())
+    vocabulary = Vocabulary('spanish', 'russian', folder=str(tmp_path), chunks_size=4, stream=True)
+    result = vocabulary.add_new_words([f'palabra {index}' for index in range(20)], use_async=True)
+    assert result['success'] and len(result['added_words']) == 20
+    assert all('parse_errors' in item['result'] for item in result['thread_results'])
+    assert gpt_helper.limiter.retries > 0
+
+
+def test_add_new_words_in_running_loop(chat_server, tmp_path):
+    vocabulary = Vocabulary('spanish', 'russian', folder=str(tmp_path), chunks_size=5)
+
+    async def build():
+        with pytest.raises(Exception, match='async_add_new_words'):
+            vocabulary.add_new_words(['casa'], use_async=True)
+        return await vocabulary.async_add_new_words(['casa', 'perro'])
+
+    result = asyncio.run(build())
+    assert result['success'] and len(result['added_words']) == 2
+
+
+def test_create_vocabulary_retries_missing_words(gpt_cache, tmp_path):
+    words = [f'palabra {index}' for index in range(30)]
+    backend = gpt_helper.set_backend(WordsBackend(skip=['palabra 3', 'palabra 25']))
+    result = create_vocabulary(words, 'spanish', 'russian', 'test', 'test', folder=str(tmp_path), create_new=True)
+    assert result['success'] and not result['dead_letters']
+    assert len(result['modified_words']) == 30 and result['file'].exists()
+    # 2 chunks of chunks_size + retry of missed words (one chunk or one per word, as answers come)
+    assert backend.calls in (3, 4)
+
+
+def test_add_new_words_resumes_from_journal(gpt_cache, tmp_path):
+    backend = gpt_helper.set_backend(WordsBackend())
+    words = [f'palabra {index}' for index in range(12)]
+    vocabulary = Vocabulary('spanish', 'russian', folder=str(tmp_path), chunks_size=5)
+    # journal of interrupted run with 10 of 12 words
+    vocabulary.journal.append(vocabulary_words_make(words[:10]))
+    vocabulary.journal.close()
+
+    result = vocabulary.add_new_words(words)
+    assert result['success'] and len(vocabulary.words_modified) == 12
+    assert backend.calls == 1 and backend.requested == words[10:]
+    assert not vocabulary.journal.file.exists()
+
+
+@pytest.fixture
+def speach_server():
+    server, url = stub_servers.server_start(stub_servers.SpeachStubHandler)
+    stub_servers.SpeachStubHandler.requests_count = 0
+    yield url
+    stub_servers.SpeachStubHandler.token_content_type = 'text/plain'
+    stub_servers.SpeachStubHandler.token_status = 200
+    server.shutdown()
+
+
+def test_audio_batch_without_ffmpeg(speach_server, tmp_path, monkeypatch):
+    audio_convert = audio_split.audio_convert
+    monkeypatch.setattr(audio_split, 'audio_convert',
+                        lambda content, extension='mp3': audio_convert(content, extension, app_path='no-such-ffmpeg'))
+    speach = MSSpeach('stub', 'stub', tts_api_url=f'{speach_server}/cognitiveservices',
+                      token_api_url=f'{speach_server}/sts')
+    files = vocabulary_audio.texts_audio_batch(['casa', 'perro', 'gato'], speach, folder=tmp_path)
+
+    # batch audio could not be converted to mp3, so every text is requested in mp3
+    assert len(files) == 3 and all(file.read_bytes().startswith(b'AUDIO:') for file in files)
+    assert stub_servers.SpeachStubHandler.requests_count == 4
+    with pytest.raises(Exception, match='not found'):
+        audio_convert(b'', app_path='no-such-ffmpeg')
+
+
+def test_audio_store_index_reload(tmp_path):
+    store = AudioStore(tmp_path / 'store')
+    file = store.put('ab01', b'AUDIO', 'mp3', text='casa', voice='es-ES-AlvaroNeural')
+    assert file == tmp_path / 'store' / 'ab' / 'ab01.mp3' and file.read_bytes() == b'AUDIO'
+
+    store = AudioStore(tmp_path / 'store')
+    assert store.has('ab01') and not store.has('ab02')
+    assert store.get('ab01') == file
+
+
+def test_audio_store_export_anki_names(tmp_path):
+    # name which make_audio_filename() of anki_cards/_scripts.js makes from text of card field
+    scripts = Path(__file__).parent.joinpath('anki_cards', '_scripts.js').read_text(encoding='utf-8')
+    prefix = scripts.split('var audioPrefix = "', 1)[1].split('"', 1)[0]
+    extension = scripts.split('var audioExtension = "', 1)[1].split('"', 1)[0]
+
+    def script_name(text):
+        name = prefix + text.replace('\u00a0', ' ').strip()
+        return name + extension if name.endswith('.') else f'{name}.{extension}'
+
+    store = AudioStore(tmp_path / 'store')
+    texts = ['la casa', 'Mi casa.', '\u00a0el perro ']
+    for index, text in enumerate(texts):
+        store.put(f'ab0{index}', text.encode('utf-8'), 'mp3', text=text, voice='es-ES-AlvaroNeural')
+    exported = store.export_anki(tmp_path / 'anki', vocabulary_audio.anki_audio_name, voice='es-ES-AlvaroNeural')
+
+    assert sorted(file.name for file in (tmp_path / 'anki').iterdir()) == sorted(script_name(text) for text in texts)
+    assert exported['Mi casa.'].name == 'ATTS Mi casa.mp3' and exported['la casa'].read_bytes() == b'la casa'
+
+
+def test_audio_generate_skips_stored_texts(speach_server, tmp_path):
+    speach = MSSpeach('stub', 'stub', tts_api_url=f'{speach_server}/cognitiveservices',
+                      token_api_url=f'{speach_server}/sts')
+    store = AudioStore(tmp_path / 'store')
+    vocabulary = Vocabulary('spanish', 'russian', 'test', 'test', folder=str(tmp_path))
+    vocabulary.set_words_modified(vocabulary_words_make(['casa', 'perro']))
+    manifest = vocabulary_audio.audio_generate(vocabulary, speach, folder=tmp_path / 'audio', fields=('word',),
+                                               store=store)
+    assert sorted(manifest['generated']) == ['casa', 'perro'] and stub_servers.SpeachStubHandler.requests_count == 2
+
+    vocabulary.set_words_modified(vocabulary_words_make(['casa', 'perro', 'gato']))
+    manifest = vocabulary_audio.audio_generate(vocabulary, speach, folder=tmp_path / 'audio', fields=('word',),
+                                               store=AudioStore(tmp_path / 'store'))
+    assert manifest['generated'] == ['gato'] and sorted(manifest['existing']) == ['casa', 'perro']
+    assert stub_servers.SpeachStubHandler.requests_count == 3
+    assert (tmp_path / 'audio' / 'ATTS gato.mp3').exists()
+
+
+def test_speach_jwt_token(speach_server):
+    stub_servers.SpeachStubHandler.token_content_type = 'application/jwt'
+    speach = MSSpeach('stub-jwt', 'stub', tts_api_url=f'{speach_server}/cognitiveservices',
+                      token_api_url=f'{speach_server}/sts')
+    speach.ssml_to_speach(speach.ssml_make('casa'))
+    assert stub_servers.SpeachStubHandler.last_authorization.startswith('Bearer token-')
+
+
+def test_speach_token_failure_backoff(speach_server):
+    stub_servers.SpeachStubHandler.token_status = 500
+    stub_servers.SpeachStubHandler.tokens_count = 0
+    speach = MSSpeach('stub-fail', 'stub', tts_api_url=f'{speach_server}/cognitiveservices',
+                      token_api_url=f'{speach_server}/sts')
+    for text in ('casa', 'perro', 'gato'):
+        speach.ssml_to_speach(speach.ssml_make(text))
+    # issuing is tried once, requests are sent with key during backoff
+    assert stub_servers.SpeachStubHandler.tokens_count == 1
+    assert stub_servers.SpeachStubHandler.requests_count == 3
+    assert stub_servers.SpeachStubHandler.last_authorization is None
+
+    speach.token_manager.failed_until = 0
+    stub_servers.SpeachStubHandler.token_status = 200
+    speach.ssml_to_speach(speach.ssml_make('casa'))
+    assert stub_servers.SpeachStubHandler.last_authorization.startswith('Bearer token-')
+    speach.token_manager.stop()
+
+
+def test_chat_stub_cli(gpt_cache):
+    process = Popen([sys.executable, 'stub_servers.py', 'chat', '--port', '0'], stdout=PIPE, text=True,
+                    cwd=Path(__file__).parent)
+    try:
+        url = process.stdout.readline().split()[-1]
+        gpt_helper.set_backend(gpt_helper.OpenAIBackend(url=f'{url}/v1/chat/completions', api_token='stub'))
+        result = gpt_helper.send_question('words:\n' + str([{'id': 0, 'word': 'casa'}]))
+        assert result['success'] and gpt_lang.answer_check(result['data']['message'])
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def vocabulary_words_make(words: list):
+    return [dict(stub_servers.ChatStubHandler.word_make({'id': index, 'word': word}), source='test, test')
+            for index, word in enumerate(words)]
+
+
+def word_entry_make(word_id, word, is_irregular):
+    return dict(stub_servers.ChatStubHandler.word_make({'id': word_id, 'word': word}), is_irregular=is_irregular,
+                source='test, test', word_translation_verify=f'ru:{word}', note='')
+
+
+def test_word_entry_json_round_trip():
+    data = word_entry_make(0, 'casa', False)
+    entry = WordEntry.from_json(WordEntry(**data).to_json())
+    assert entry.to_dict() == data and list(entry.keys()) == list(data.keys())
+    assert entry['id'] == 0 and entry['is_irregular'] is False
+    assert entry['word_translation_verify'] == 'ru:casa' and 'note' in entry and 'anki_tags' not in entry
+
+
+def test_word_entry_csv_round_trip(tmp_path):
+    words = [word_entry_make(0, 'casa', False), word_entry_make(1, 'ser', True)]
+    vocabulary = Vocabulary('spanish', 'russian', 'test', 'test', folder=str(tmp_path))
+    vocabulary.set_words_modified(words)
+    file = vocabulary.write_to_file()
+
+    loaded = Vocabulary.load_vocabulary(file)
+    assert all(isinstance(word, WordEntry) for word in loaded.words_modified)
+    # csv keeps all columns in order, values are read back as text
+    assert [list(word.keys()) for word in loaded.words_modified] == [list(word.keys()) for word in words]
+    assert [{key: str(value) for key, value in word.items()} for word in words] == \
+           [word.to_dict() for word in loaded.words_modified]
+    assert (loaded.words_modified[0]['id'], loaded.words_modified[0]['is_irregular']) == ('0', 'False')
+
+    content = file.read_text(encoding='utf-8')
+    assert loaded.write_to_file(overwrite=True) == file and file.read_text(encoding='utf-8') == content
+
+
+def test_merge_keeps_merged_file(tmp_path):
+    first = Vocabulary('spanish', 'russian', 'test', 'test', folder=str(tmp_path))
+    first.set_words_modified(vocabulary_words_make(['casa', 'perro']))
+    second = Vocabulary('spanish', 'russian', 'test', 'test', folder=str(tmp_path))
+    second.set_words_modified(vocabulary_words_make(['perro', 'gato']))
+
+    file = first.merge_vocabularies(second)
+    assert file.exists() and len(Vocabulary.load_vocabulary(file).words_modified) == 3
+
+
+def test_merge_deletes_loaded_file(tmp_path):
+    saved = Vocabulary('spanish', 'russian', 'test', 'test', folder=str(tmp_path))
+    saved.set_words_modified(vocabulary_words_make(['perro', 'gato']))
+    saved_file = saved.write_to_file()
+    loaded = Vocabulary.load_vocabulary(saved_file)
+    first = Vocabulary('spanish', 'russian', 'test', 'test', folder=str(tmp_path))
+    first.set_words_modified(vocabulary_words_make(['casa']))
+
+    file = first.merge_vocabularies(loaded)
+    assert file != saved_file and file.exists() and not saved_file.exists()
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_retry_is_not_taken_from_cache(gpt_cache, tmp_path, stream):
+    backend = gpt_helper.set_backend(WordsBackend(skip=['casa']))
+    vocabulary = Vocabulary('spanish', 'russian', folder=str(tmp_path), stream=stream)
+    result = vocabulary.add_new_words(['casa'])
+    assert result['success'] and not result['dead_letters']
+    assert backend.calls == 2
+    # only the answer with the word is kept in cache
+    assert gpt_cache.stats()['entries'] == 1
+
+
+def test_lexicon_words_have_unique_ids(gpt_cache, tmp_path):
+    gpt_helper.set_backend(WordsBackend())
+    lexicon = Lexicon(tmp_path / 'lexicon.sqlite')
+    words = [f'palabra {index}' for index in range(50)]
+    Vocabulary('spanish', 'russian', 'test', 'first', folder=str(tmp_path), lexicon=lexicon).add_new_words(words)
+
+    vocabulary = Vocabulary('spanish', 'russian', 'test', 'second', folder=str(tmp_path), lexicon=lexicon)
+    result = vocabulary.add_new_words(words + ['palabra nueva'])
+    assert result['success'] and len(vocabulary.words_modified) == 51
+    assert len({word['id'] for word in vocabulary.words_modified}) == 51
+    assert sum(word['source'] == 'test, second' for word in vocabulary.words_modified) == 50
+    lexicon.close()
@@ -0,0 +1,290 @@
+from pathlib import Path
+from json import dumps as json_dumps
+from os import replace as os_replace
+import extra_functions
+from service_speach import MSSpeach, VoiceCatalogue, locale_get, audio_content_types
+from difflib import SequenceMatcher
+from re import sub as re_sub
+from audio_store import AudioStore, audio_key
+import audio_split
+
+# anki_cards/_scripts.js looks for "ATTS <text of card field>.mp3"
+audio_prefix = 'ATTS '
+audio_format = 'audio-24khz-48kbitrate-mono-mp3'
+audio_fields = ('whole_word', 'sentence')
+# fields of each side of card: from - language which is learned (from_lang), to - translation (to_lang)
+side_fields = {
+    'from': ('whole_word', 'sentence'),
+    'to': ('word_translation', 'sentence_translation'),
+}
+# voice in format of MSSpeach.languages_get() items
+default_voice = {'ShortName': 'en-US-ChristopherNeural', 'Locale': 'en-US', 'Gender': 'Male'}
+# batch ssml is requested as wav, so it can be split by silences
+batch_audio_format = 'riff-24khz-16bit-mono-pcm'
+batch_text_length = 40
+
+
+# the same name as make_audio_filename() of anki_cards/_scripts.js gives
+def anki_audio_name(text, extension='mp3'):
+    name = audio_prefix + text.replace('\u00a0', ' ').strip()
+    return name + extension if name.endswith('.') else f'{name}.{extension}'
+
+
+# unique texts of all vocabularies (the same sentence in few decks is voiced once)
+def vocabulary_texts(vocabularies: list, fields=audio_fields):
+    texts = {}
+    for vocabulary in vocabularies:
+        for word in vocabulary.words_modified:
+            for field in fields:
+                text = (word.get(field) or '').replace('\u00a0', ' ').strip()
+                if text:
+                    texts[text] = None
+    return list(texts)
+
+
+def text_audio_make(text, speach: MSSpeach, folder='', audio_format=audio_format, voice=None):
+    voice = voice if voice else default_voice
+    extension = extension_get(audio_format)
+    file_name = anki_audio_name(text, extension)[:-len(extension) - 1]
+    return speach.text_to_speach(text, audio_format=audio_format, file_location=folder, file_name=file_name,
+                                 language=voice['Locale'], voice_name=voice['ShortName'], gender=voice['Gender'])
+
+
+def extension_get(audio_format):
+    return 'wav' if audio_format.startswith('riff') else audio_format.split('-')[-1]
+
+
+def text_audio_key(text, audio_format=audio_format, voice=None):
+    voice = voice if voice else default_voice
+    return audio_key(text, voice['ShortName'], voice['Locale'], audio_format)
+
+
+def text_audio_store(text, speach: MSSpeach, store: AudioStore, audio_format=audio_format, voice=None):
+    voice = voice if voice else default_voice
+    ssml = speach.ssml_make(text, language=voice['Locale'], voice_name=voice['ShortName'], gender=voice['Gender'])
+    content = speach.ssml_to_speach(ssml, audio_format=audio_format)
+    return store.put(text_audio_key(text, audio_format, voice), content, extension_get(audio_format), text=text,
+                     voice=voice['ShortName'], language=voice['Locale'], format=audio_format)
+
+
+# short texts (words) are grouped by batch_size, long ones (sentences) are synthesized one by one
+def texts_group(texts: list, batch_size, max_length=batch_text_length):
+    short_texts = [text for text in texts if len(text) <= max_length]
+    groups = [short_texts[i: i + batch_size] for i in range(0, len(short_texts), batch_size)]
+    return groups + [[text] for text in texts if len(text) > max_length]
+
+
+def texts_audio_batch(texts: list, speach: MSSpeach, folder='', store: AudioStore = None, audio_format=audio_format,
+                      voice=None):
+    """
+    synthesizes few texts with one request (batch ssml in wav), splits audio to clips by breaks and saves
+    each clip to store (if set) or to folder with anki name, clips are converted by ffmpeg if format is not wav
+    if audio can not be split to the same number of clips or converted (no ffmpeg), texts are synthesized one by one
+    """
+    voice = voice if voice else default_voice
+    extension = extension_get(audio_format)
+    if len(texts) == 1:
+        clips = None
+    else:
+        ssml = speach.ssml_batch_make(texts, language=voice['Locale'], voice_name=voice['ShortName'],
+                                      gender=voice['Gender'])
+        clips = audio_split.wav_split(speach.ssml_to_speach(ssml, audio_format=batch_audio_format), len(texts))
+
+    if clips and extension != 'wav':
+        try:
+            clips = [audio_split.audio_convert(clip, extension) for clip in clips]
+        except Exception:
+            clips = None
+
+    if not clips:
+        if store:
+            return [text_audio_store(text, speach, store, audio_format, voice) for text in texts]
+        return [text_audio_make(text, speach, folder, audio_format, voice) for text in texts]
+
+    files = []
+    for text, clip in zip(texts, clips):
+        if store:
+            files.append(store.put(text_audio_key(text, audio_format, voice), clip, extension, text=text,
+                                   voice=voice['ShortName'], language=voice['Locale'], format=audio_format))
+        else:
+            file = Path(folder, anki_audio_name(text, extension))
+            file.write_bytes(clip)
+            files.append(file)
+    return files
+
+
+def manifest_save(manifest: dict, file):
+    file = Path(file)
+    temp_file = file.with_suffix('.tmp')
+    temp_file.write_text(json_dumps(manifest, ensure_ascii=False, indent=1), encoding='utf-8')
+    os_replace(temp_file, file)
+    return file
+
+
+def audio_generate(vocabularies, speach: MSSpeach = None, folder='', fields=audio_fields, audio_format=audio_format,
+                   max_workers=10, manifest_file='audio_manifest.json', store: AudioStore = None, voice=None,
+                   batch_size=0):
+    """
+    creates audio files (named for anki cards) for all texts of fields of vocabularies
+    texts are deduplicated between vocabularies, texts which already have audio are skipped,
+    others are synthesized in max_workers threads (one MSSpeach, so connections are reused)
+    with store - audio is kept in AudioStore (checked by index, not by files) and exported to folder with anki names
+    batch_size > 1 - short texts are synthesized by batch_size texts in one request (see texts_audio_batch),
+                     ffmpeg is needed for formats other than wav (without it texts are synthesized one by one)
+    returns manifest (text: file name, and lists of generated, existing, failed texts) saved to folder/manifest_file
+    """
+    vocabularies = vocabularies if isinstance(vocabularies, (list, tuple)) else [vocabularies]
+    speach = speach if speach else MSSpeach()
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    extension = extension_get(audio_format)
+
+    manifest = {'files': {}, 'generated': [], 'existing': [], 'failed': {}}
+    texts = vocabulary_texts(vocabularies, fields)
+    to_generate = []
+    for text in texts:
+        file_name = anki_audio_name(text, extension)
+        manifest['files'][text] = file_name
+        if store:
+            exists = store.has(text_audio_key(text, audio_format, voice))
+        else:
+            exists = folder.joinpath(file_name).exists()
+
+        if exists:
+            manifest['existing'].append(text)
+        else:
+            to_generate.append(text)
+
+    if batch_size > 1:
+        results = extra_functions.threads_run(texts_audio_batch, texts_group(to_generate, batch_size),
+                                              [speach, folder, store, audio_format, voice], max_workers=max_workers)
+    elif store:
+        results = extra_functions.threads_run(text_audio_store, to_generate, [speach, store, audio_format, voice],
+                                              max_workers=max_workers)
+    else:
+        results = extra_functions.threads_run(text_audio_make, to_generate, [speach, folder, audio_format, voice],
+                                              max_workers=max_workers)
+
+    for result in results:
+        result_texts = result['data'] if isinstance(result['data'], list) else [result['data']]
+        for text in result_texts:
+            if result['error']:
+                manifest['failed'][text] = str(result['error'])
+                manifest['files'].pop(text, None)
+            else:
+                manifest['generated'].append(text)
+
+    if store:
+        voice = voice if voice else default_voice
+        store.export_anki(folder, anki_audio_name, texts=texts, voice=voice['ShortName'], format=audio_format)
+
+    if manifest_file:
+        manifest_save(manifest, folder.joinpath(manifest_file))
+    return manifest
+
+
+def vocabularies_audio_generate(vocabularies, speach: MSSpeach = None, catalogue: VoiceCatalogue = None, folder='',
+                                sides=('from', 'to'), gender=None, style=None, manifest_file='audio_manifest.json',
+                                **generate_kwargs):
+    """
+    audio_generate() for both sides of cards: texts of every side are voiced with voice of its language
+    (from_lang / to_lang of vocabulary), voices are selected from catalogue (cached list, no request per clip)
+    generate_kwargs - other parameters of audio_generate (store, batch_size, audio_format, max_workers)
+    """
+    vocabularies = vocabularies if isinstance(vocabularies, (list, tuple)) else [vocabularies]
+    speach = speach if speach else MSSpeach()
+    catalogue = catalogue if catalogue else VoiceCatalogue(speach)
+
+    groups = {}
+    for vocabulary in vocabularies:
+        for side in sides:
+            language = vocabulary.from_lang if side == 'from' else vocabulary.to_lang
+            groups.setdefault((side, language.lower()), []).append(vocabulary)
+
+    manifest = {'files': {}, 'generated': [], 'existing': [], 'failed': {}, 'voices': {}}
+    for (side, language), side_vocabularies in groups.items():
+        voice = catalogue.voice_select(language, gender=gender, style=style)
+        side_manifest = audio_generate(side_vocabularies, speach, folder=folder, fields=side_fields[side],
+                                       manifest_file=None, voice=voice, **generate_kwargs)
+        manifest['voices'][f'{side}:{language}'] = voice['ShortName']
+        manifest['files'].update(side_manifest['files'])
+        manifest['generated'] += side_manifest['generated']
+        manifest['existing'] += side_manifest['existing']
+        manifest['failed'].update(side_manifest['failed'])
+
+    if manifest_file:
+        manifest_save(manifest, Path(folder).joinpath(manifest_file))
+    return manifest
+
+
+def text_compare_normalize(text):
+    text = re_sub(r'[^\w\s]', ' ', extra_functions.word_normalize(text))
+    return ' '.join(text.split())
+
+
+# 0..1 - how close is recognized text to expected (1 - the same after normalization)
+def pronunciation_score(expected, recognized):
+    return round(SequenceMatcher(None, text_compare_normalize(expected), text_compare_normalize(recognized)).ratio(), 3)
+
+
+# expected texts by recording names: "<id>", "<text>" or "ATTS <text>" (file name of card audio)
+def expected_texts_get(vocabularies: list, fields=('sentence', 'whole_word')):
+    expected = {}
+    for vocabulary in vocabularies:
+        for word in vocabulary.words_modified:
+            texts = [word.get(field) for field in fields if word.get(field)]
+            if not texts:
+                continue
+            if word.get('id') not in (None, ''):
+                expected.setdefault(str(word['id']), texts[0])
+            for text in texts:
+                expected.setdefault(text_compare_normalize(text), text)
+    return expected
+
+
+def recording_check(file: Path, expected_text, speach: MSSpeach, language):
+    result = speach.speach_to_text(file, language=language)
+    recognized = result.get('DisplayText', '') if isinstance(result, dict) else ''
+    return {
+                'file': str(file),
+                'expected': expected_text,
+                'recognized': recognized,
+                'status': result.get('RecognitionStatus') if isinstance(result, dict) else None,
+                'score': pronunciation_score(expected_text, recognized),
+           }
+
+
+def pronunciation_check(folder, vocabularies, speach: MSSpeach = None, language=None, fields=('sentence', 'whole_word'),
+                        max_workers=10):
+    """
+    recognizes all recordings of folder (streamed upload, max_workers at the same time) and compares them
+    with expected text of vocabulary entry, recording is matched to entry by file name (id of word or its text)
+    returns list of results (file, expected, recognized, score) and list of files without expected text
+    """
+    vocabularies = vocabularies if isinstance(vocabularies, (list, tuple)) else [vocabularies]
+    speach = speach if speach else MSSpeach()
+    language = locale_get(language if language else vocabularies[0].from_lang)
+    expected = expected_texts_get(vocabularies, fields)
+
+    files = []
+    unknown = []
+    for file in sorted(Path(folder).iterdir()):
+        if file.suffix.lower() not in audio_content_types:
+            continue
+        name = file.stem[len(audio_prefix):] if file.stem.startswith(audio_prefix) else file.stem
+        expected_text = expected.get(name) or expected.get(text_compare_normalize(name))
+        if expected_text:
+            files.append((file, expected_text))
+        else:
+            unknown.append(str(file))
+
+    results = extra_functions.threads_run(lambda item: recording_check(item[0], item[1], speach, language), files,
+                                          max_workers=max_workers)
+    checked = []
+    for result in results:
+        if result['error']:
+            checked.append({'file': str(result['data'][0]), 'expected': result['data'][1], 'recognized': None,
+                            'status': 'Error', 'score': 0, 'error': str(result['error'])})
+        else:
+            checked.append(result['result'])
+    return {'results': sorted(checked, key=lambda item: item['file']), 'unknown_files': unknown}
@@ -0,0 +1,94 @@
+from json import dumps as json_dumps
+from json import loads as json_loads
+
+# fields of words asked from GPT (see gpt_lang.create_request_fields) + fields added later (anki tags)
+fields = ('id', 'word', 'whole_word', 'word_translation', 'sentence', 'sentence_translation', 'type', 'is_irregular',
+          'level', 'language', 'to_language', 'topics', 'source', 'anki_tags', 'anki_tags_notion')
+fields_set = frozenset(fields)
+
+
+class WordEntry:
+    """
+    one word of vocabulary, keeps known fields in slots (no per row dict with repeated key strings)
+    unknown fields are kept in "extra" dict, so nothing is lost on load/save
+    behaves like dict for reading/writing fields (word['sentence'], word.get(...), keys(), items(), dict(word))
+    """
+    __slots__ = fields + ('extra',)
+
+    def __init__(self, **values):
+        self.extra = None
+        for field, value in values.items():
+            self[field] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**dict(data.items()))
+
+    @classmethod
+    def from_json(cls, data: str):
+        return cls.from_dict(json_loads(data))
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in fields if hasattr(self, field)}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def to_json(self):
+        return json_dumps(self.to_dict(), ensure_ascii=False)
+
+    def __getitem__(self, field):
+        if field in fields_set:
+            try:
+                return getattr(self, field)
+            except AttributeError:
+                raise KeyError(field) from None
+        if self.extra and field in self.extra:
+            return self.extra[field]
+        raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        if field in fields_set:
+            setattr(self, field, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[field] = value
+
+    def __contains__(self, field):
+        if field in fields_set:
+            return hasattr(self, field)
+        return bool(self.extra) and field in self.extra
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def values(self):
+        return self.to_dict().values()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (WordEntry, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f'WordEntry({self.to_dict()!r})'
+
+
+def entries_make(words: list):
+    return [word if isinstance(word, WordEntry) else WordEntry.from_dict(word) for word in words]
@@ -3,9 +3,22 @@ from pathlib import Path
 import gpt_lang
 import gpt_helper
 import spanish_dict
+from journal import Journal
+from metrics import metrics
+from json_stream import JSONArrayParser, array_items
+from retry_scheduler import RetryScheduler, retry_priority
+from work_queue import WorkQueue
+from post_process import PostProcessor, answer_parse
+from lexicon import Lexicon
+from threading import Thread
+from time import sleep
+from word_entry import WordEntry, entries_make
 from traceback import format_exc as traceback_format_exc
 from json import loads as json_loads
 from unicodedata import normalize as uni_normalize
+from functools import partial
+from time import perf_counter
+import asyncio
 
 # to make as class WordsClient
 # as functions have a lot of parameters, which should be set with object creation
@@ -13,14 +26,18 @@ supported_from_lang = {}
 supported_to_lang = {}
 
 
-class Vocabulary:
+merge_policies = ('keep_first', 'keep_newest', 'fill')
+
 
-    words_unmodified = []
-    words_modified = []
-    words_missing = []
+class Vocabulary:
 
     def __init__(self, from_lang, to_lang, vocabulary_source='custom', vocabulary_name='custom', level='A1',
-                 folder='results', threads_workers=5, chunks_size=20):
+                 folder='results', threads_workers=5, chunks_size=20, concurrency=100, tokens_budget=4096,
+                 translator=None, translate_mode='fill', metrics_file=None, stream=False, max_attempts=3,
+                 post_processor: PostProcessor = None, lexicon: Lexicon = None):
+        self.words_unmodified = []
+        self.words_modified = []
+        self.words_missing = []
         self.from_lang = from_lang
         self.to_lang = to_lang
         self.vocabulary_source = vocabulary_source.replace(' ', '_')
@@ -30,6 +47,30 @@ class Vocabulary:
         self.file_name = f'{self.from_lang}_{self.to_lang}.{self.vocabulary_source}_{self.vocabulary_name}'
         self.threads_workers = threads_workers
         self.chunks_size = chunks_size
+        self.concurrency = concurrency
+        # max tokens of one request (model context size), chunks are packed up to it, 0 - use only chunks_size
+        self.tokens_budget = tokens_budget
+        # service_translate.TranslationEngine, fills/verifies translations of found words (see translate_mode)
+        self.translator = translator
+        self.translate_mode = translate_mode
+        # metrics summary is written there after add_new_words (.prom / .txt - prometheus text, otherwise json)
+        self.metrics_file = metrics_file
+        # answers are streamed and every word is saved to journal as soon as its json is complete
+        self.stream = stream
+        # tries of every word, words which are not found after that are in dead_letters of add_new_words result
+        self.max_attempts = max_attempts
+        # process pool for normalization of words, parsing of answers (while other requests are in work) and csv
+        self.post_processor = post_processor
+        # words known for language pair (found for other vocabularies) are taken from lexicon, not from GPT
+        self.lexicon = lexicon
+        self.journal = Journal(self.journal_file_get(self.folder, self.file_name))
+        self.words_index = extra_functions.WordsIndex(self.words_modified)
+        # csv file which vocabulary was loaded from or last written to, only it is removed by delete()
+        self.file = None
+
+    @staticmethod
+    def journal_file_get(folder, file_name):
+        return Path(folder).joinpath(f'{file_name}.journal.jsonl')
 
     def is_similar(self, other_vocab):
         return (
@@ -45,9 +86,17 @@ class Vocabulary:
         return words
 
     def set_words_modified(self, words: list):
+        words = entries_make(words)
         self.words_modified = words
+        self.words_index = extra_functions.WordsIndex(words)
         return words
 
+    def add_words_modified(self, words: list):
+        words = entries_make(words)
+        self.words_modified = self.words_modified + words
+        self.words_index.add(words)
+        return self.words_modified
+
     def set_words_missing(self, words: list):
         self.words_missing = words
         return words
@@ -61,7 +110,7 @@ class Vocabulary:
     def load_vocabulary(file_path):
         file = extra_functions.make_file_object(file_path, with_exception=True)
         folder = str(file.parent)
-        file_data = extra_functions.load_data_from_csv_file(str(file))
+        file_data = entries_make(extra_functions.iter_data_from_csv_file(str(file)))
         one_line = file_data[0]
         vocab = Vocabulary(
                             from_lang=one_line['language'],
@@ -72,26 +121,57 @@ class Vocabulary:
                             folder=folder
                          )
         vocab.set_words_modified(file_data)
+        vocab.file = file
         return vocab
 
-    def merge_vocabularies(self, other_vocab):
-
-        if not self.is_similar(other_vocab):
-            raise Exception('Vocabularies should be identical in from_lang,to_lang, vocabulary_source, vocabulary_name, level')
-
-        merged_list = self.words_modified
-        for obj in other_vocab.words_modified:
-            if obj not in merged_list:
-                merged_list.append(obj)
-
-        self.set_words_modified(merged_list)
-        self.write_to_file()
-        other_vocab.delete()
+    # words_lists are merged in given order, so for keep_newest the last list is the newest one
+    # policies: keep_first - first word with the key is kept, keep_newest - last one is kept,
+    #           fill - first one is kept, its empty fields are filled from next ones
+    @staticmethod
+    def words_merge(words_lists: list, key='whole_word', policy='keep_first'):
+        if policy not in merge_policies:
+            raise Exception(f'merge policy should be one of: {", ".join(merge_policies)}')
+
+        merged_list = []
+        positions = {}
+        for words in words_lists:
+            for word in words:
+                word_key = extra_functions.word_normalize(word.get(key) or word.get('word') or '')
+                position = positions.get(word_key) if word_key else None
+                if position is None:
+                    if word_key:
+                        positions[word_key] = len(merged_list)
+                    merged_list.append(WordEntry.from_dict(word))
+
+                elif policy == 'keep_newest':
+                    merged_list[position] = WordEntry.from_dict(word)
+
+                elif policy == 'fill':
+                    merged_word = merged_list[position]
+                    for field, value in word.items():
+                        if merged_word.get(field) in (None, ''):
+                            merged_word[field] = value
+        return merged_list
+
+    def merge_vocabularies(self, *other_vocabs, key='whole_word', policy='keep_first'):
+        for other_vocab in other_vocabs:
+            if not self.is_similar(other_vocab):
+                raise Exception('Vocabularies should be identical in from_lang,to_lang, vocabulary_source, vocabulary_name, level')
+
+        words_lists = [self.words_modified] + [other_vocab.words_modified for other_vocab in other_vocabs]
+        self.set_words_modified(self.words_merge(words_lists, key=key, policy=policy))
+        file = self.write_to_file()
+        for other_vocab in other_vocabs:
+            # vocabulary of the same folder can have the file which was just overwritten by merged words
+            if other_vocab.file and Path(other_vocab.file).resolve() == Path(file).resolve():
+                other_vocab.file = None
+            other_vocab.delete()
+        return file
 
     def delete(self, remove_related_search=True):
-        file = Path(self.folder)
-        file = file.joinpath(self.file_name)
-        file.unlink()
+        if self.file:
+            Path(self.file).unlink(missing_ok=True)
+            self.file = None
 
         if remove_related_search:
             self.search_cleanup()
@@ -100,23 +180,150 @@ class Vocabulary:
         self.set_words_modified(modified_words)
         return self.write_to_file()
 
-    def add_new_words(self, words: list, overwrite=True):
-        words = extra_functions.words_standardize(words)
-        words_to_search = extra_functions.check_missing(new_words=words, existing_words=self.words_modified)
-        thread_results = self.search_make(words=words_to_search)
-        self.search_save(thread_results)
+    # use_async - send all chunks concurrently (up to self.concurrency) on aiohttp instead of self.threads_workers
+    #             threads, inside running event loop use "await async_add_new_words()" instead
+    # not found words are retried in smaller chunks (see search_make), dead_letters - words given up after max_attempts
+    # metrics of the process (metrics.metrics, since start or its reset()) are returned and exported to metrics_file
+    def add_new_words(self, words: list, overwrite=True, use_async=False):
+        if use_async:
+            return coroutine_run(self.async_add_new_words(words, overwrite=overwrite))
+
+        with metrics.timer('add_new_words_seconds'):
+            known_words, words_to_search = self.search_prepare(words)
+            scheduler = RetryScheduler(chunk_size=self.chunks_size, max_attempts=self.max_attempts)
+            with metrics.timer('search_seconds'):
+                thread_results = self.search_make(words=words_to_search, scheduler=scheduler)
+            result = self.search_finish(known_words, words_to_search, thread_results, scheduler, overwrite=overwrite)
+        return self.metrics_export(result)
+
+    async def async_add_new_words(self, words: list, overwrite=True, concurrency=None):
+        with metrics.timer('add_new_words_seconds'):
+            known_words, words_to_search = self.search_prepare(words)
+            scheduler = RetryScheduler(chunk_size=self.chunks_size, max_attempts=self.max_attempts)
+            with metrics.timer('search_seconds'):
+                thread_results = await self.async_search_make(words=words_to_search, concurrency=concurrency,
+                                                              scheduler=scheduler)
+            result = self.search_finish(known_words, words_to_search, thread_results, scheduler, overwrite=overwrite)
+        return self.metrics_export(result)
+
+    # after add_new_words_seconds of the run is recorded, so summary and metrics_file include the run
+    def metrics_export(self, result: dict):
+        result['metrics'] = metrics.summary()
+        if self.metrics_file:
+            metrics.export(self.metrics_file)
+        return result
+
+    # words which are not in vocabulary: taken from lexicon and the ones which should be requested
+    # words saved in journal (and offset files) by interrupted search are not requested again,
+    # search_finish adds them to vocabulary with search_results
+    def search_prepare(self, words: list):
+        words = self.words_standardize(words)
+        words_to_search = extra_functions.check_missing(new_words=words, existing_words=self.words_index)
+        saved_words = self.search_results()
+        if saved_words and words_to_search:
+            words_to_search = extra_functions.check_missing(new_words=words_to_search, existing_words=saved_words)
+            metrics.count('words_resumed', len(saved_words))
+        return self.lexicon_split(words_to_search)
+
+    def search_finish(self, known_words: list, words_to_search: list, thread_results: list,
+                      scheduler: RetryScheduler, overwrite=True):
         found_words = self.search_results()
-        self.set_words_modified(self.words_modified + found_words)
+        if self.lexicon:
+            self.lexicon.put_many(self.from_lang, self.to_lang, found_words)
+        found_words += known_words
+        if self.translator:
+            with metrics.timer('translate_seconds'):
+                self.translator.fill_vocabulary(found_words, self.from_lang, self.to_lang, mode=self.translate_mode)
+        self.add_words_modified(found_words)
 
         file = self.write_to_file(overwrite=overwrite)
         self.search_cleanup()
-        missing_words = extra_functions.check_missing(new_words=words, existing_words=self.words_modified)
+        missing_words = extra_functions.check_missing(new_words=words_to_search, existing_words=self.words_index)
+        metrics.count('words_requested', len(words_to_search))
+        metrics.count('words_added', len(found_words))
+        metrics.count('words_missing', len(missing_words))
         return {'success': not missing_words,
                 'thread_results': thread_results,
                 'added_words': found_words,
                 'missing_words': missing_words,
+                'dead_letters': scheduler.dead_letters,
                 'file': file}
 
+    # returns words which are in lexicon (as words of this vocabulary) and words which should be requested
+    # requested words get ids from 0 (see words_chunk), so ids of known words go after them
+    def lexicon_split(self, words: list):
+        if not self.lexicon or not words:
+            return [], words
+
+        found = self.lexicon.get_many(self.from_lang, self.to_lang, words)
+        known = []
+        words_to_search = []
+        for word in words:
+            data = found.get(extra_functions.word_normalize(word))
+            if data is None:
+                words_to_search.append(word)
+            else:
+                known.append((word, data))
+        # fields of this vocabulary, as GPT would set them by request message
+        known_words = [dict(data, id=len(words_to_search) + index, word=word, level=self.level or data.get('level'),
+                            source=f'{self.vocabulary_source}, {self.vocabulary_name}')
+                       for index, (word, data) in enumerate(known)]
+        metrics.count('lexicon_hits', len(known_words))
+        metrics.count('lexicon_misses', len(words_to_search))
+        return known_words, words_to_search
+
+    # parameters which workers of work queue need to make requests for this vocabulary
+    def params_get(self):
+        return {'from_lang': self.from_lang, 'to_lang': self.to_lang, 'vocabulary_source': self.vocabulary_source,
+                'vocabulary_name': self.vocabulary_name, 'level': self.level, 'chunks_size': self.chunks_size,
+                'tokens_budget': self.tokens_budget, 'max_attempts': self.max_attempts}
+
+    # not found words are put to work queue (queue name is file name of vocabulary) as chunks,
+    # then any process can work on them (queue_work() or "python work_queue.py <file>") and queue_collect() them
+    def queue_fill(self, words: list, work_queue: WorkQueue):
+        words = self.words_standardize(words)
+        words_to_search = extra_functions.check_missing(new_words=words, existing_words=self.words_index)
+        known_words, words_to_search = self.lexicon_split(words_to_search)
+        if known_words:
+            work_queue.put(self.file_name, [{'lexicon': True, 'words': []}], status='done', result=known_words)
+        payloads = [{'vocabulary': self.params_get(), 'words': chunk} for chunk in self.words_chunk(words_to_search)]
+        return work_queue.put(self.file_name, payloads)
+
+    # words of done items are added to vocabulary and file, cleanup - queue is deleted when it's drained
+    def queue_collect(self, work_queue: WorkQueue, overwrite=True, cleanup=True):
+        found_words = []
+        for item in work_queue.items_get(self.file_name, status='done'):
+            if self.lexicon and item['result'] and not item['payload'].get('lexicon'):
+                self.lexicon.put_many(self.from_lang, self.to_lang, item['result'])
+            found_words += item['result'] or []
+        # words collected before (queue is collected while other workers are still working) are skipped
+        found_words = [word for word in self.words_merge([found_words], key='word')
+                       if word.get('word') not in self.words_index]
+        dead_letters = [{'word': word['word'], 'attempts': max(item['payload'].get('word_attempts', 0), item['attempts']),
+                         'error': item['error']}
+                        for item in work_queue.items_get(self.file_name, status='dead')
+                        for word in item['payload']['words']]
+        if self.translator:
+            self.translator.fill_vocabulary(found_words, self.from_lang, self.to_lang, mode=self.translate_mode)
+        self.add_words_modified(found_words)
+
+        file = self.write_to_file(overwrite=overwrite)
+        stats = work_queue.stats(self.file_name)
+        drained = not stats['ready'] and not stats['leased']
+        if cleanup and drained:
+            work_queue.delete(self.file_name)
+        return {'success': drained and not dead_letters,
+                'added_words': found_words,
+                'dead_letters': dead_letters,
+                'queue': stats,
+                'file': file}
+
+    # add_new_words through work queue in this process, other processes can work on the same queue at the same time
+    def add_new_words_queued(self, words: list, work_queue: WorkQueue, overwrite=True):
+        self.queue_fill(words, work_queue)
+        queue_work(work_queue, queue=self.file_name, max_workers=self.threads_workers)
+        return self.queue_collect(work_queue, overwrite=overwrite)
+
     def write_to_file(self, overwrite=False):
         file_name = f'{self.from_lang}_{self.to_lang}.{self.vocabulary_source}_{self.vocabulary_name}'.lower()
         current_files = extra_functions.find_matching_files(self.folder, file_name, '.csv')
@@ -129,101 +336,335 @@ class Vocabulary:
         file_name = f'{file_name}{index}'
         file = Path(self.folder)
         file = file.joinpath(file_name)
-        return extra_functions.write_data_to_csv_file(str(file), self.words_modified)
+        if self.post_processor and self.words_modified:
+            # columns are taken from first row as in write_data_to_csv_file
+            fieldnames = list(self.words_modified[0].keys())
+            parts = self.post_processor.csv_parts(self.words_modified, fieldnames)
+            self.file = extra_functions.write_csv_parts_to_file(file.with_name(f'{file.name}.csv'), fieldnames, parts)
+        else:
+            self.file = extra_functions.write_data_to_csv_file(str(file), self.words_modified)
+        return self.file
+
+    def words_standardize(self, words: list):
+        if self.post_processor:
+            return self.post_processor.words_standardize(words)
+        return extra_functions.words_standardize(words)
+
+    def request_message(self):
+        return gpt_lang.create_request_message(self.from_lang, self.to_lang, self.vocabulary_source,
+                                               self.vocabulary_name, self.level)
+
+    def words_chunk(self, words: list):
+        budget = 0
+        if self.tokens_budget:
+            budget = self.tokens_budget - gpt_helper.tokens_estimate(self.request_message())
+        return extra_functions.format_words_list(words, self.chunks_size, tokens_budget=budget,
+                                                 item_tokens=gpt_lang.word_tokens_estimate)
+
+    # attempt > 0 - words were not found in previous answer, so it's not taken from cache (it would be the same)
+    def chunk_send(self, words_list: list, attempt=0):
+        question = self.request_message() + str(words_list)
+        use_cache = not attempt
+        if self.stream:
+            on_delta, stream_result_make = self.stream_receiver_make()
+            result = gpt_helper.send_question(question, use_cache=use_cache, on_delta=on_delta,
+                                              cache_check=gpt_lang.answer_check)
+            return stream_result_make(result)
+
+        result = gpt_helper.send_question(question, use_cache=use_cache, cache_check=gpt_lang.answer_check)
+        if self.post_processor and result['success']:
+            # answer is parsed in process pool (only thread of this request waits for it)
+            parsed = self.post_processor.submit(answer_parse, result['data']['message']).result()
+            self.answer_parsed_save(result, parsed)
+        return result
+
+    async def async_chunk_send(self, words_list: list, attempt=0):
+        question = self.request_message() + str(words_list)
+        use_cache = not attempt
+        if self.stream:
+            on_delta, stream_result_make = self.stream_receiver_make()
+            result = await gpt_helper.async_send_question(question, use_cache=use_cache, on_delta=on_delta,
+                                                          cache_check=gpt_lang.answer_check)
+            return stream_result_make(result)
+
+        result = await gpt_helper.async_send_question(question, use_cache=use_cache,
+                                                      cache_check=gpt_lang.answer_check)
+        if self.post_processor and result['success']:
+            future = self.post_processor.submit(answer_parse, result['data']['message'])
+            self.answer_parsed_save(result, await asyncio.wrap_future(future))
+        return result
+
+    # words parsed by post processor are saved to journal here, so main thread gets result with "items"
+    # already saved, as streamed one
+    def answer_parsed_save(self, result, parsed):
+        if parsed['broken']:
+            metrics.count('gpt_answer_parse_errors')
+        if parsed['error']:
+            result['parse_error'] = parsed['error']
+        self.journal.append(parsed['items'])
+        result['items'] = parsed['items']
+        result['saved'] = True
+        return result
+
+    # words of streamed answer are parsed and appended to journal while answer is coming,
+    # so broken end of answer costs only words which were not finished
+    # returns on_delta for send_question and function which adds to its result "items" - saved words
+    # and "parse_errors" - count of skipped not valid words
+    def stream_receiver_make(self):
+        parser = JSONArrayParser()
+        items = []
+        start = perf_counter()
+
+        def on_delta(text):
+            new_items = parser.feed(text)
+            if new_items:
+                if not items:
+                    metrics.observe('gpt_first_item_seconds', perf_counter() - start)
+                self.journal.append(new_items)
+                items.extend(new_items)
+
+        def stream_result_make(result):
+            result['items'] = items
+            result['saved'] = True
+            result['parse_errors'] = parser.errors
+            metrics.count('gpt_answer_parse_errors', parser.errors)
+            return result
+
+        return on_delta, stream_result_make
+
+    # saves words of answer of one chunk to journal, returns words of chunk which are not in answer and error
+    def chunk_result_save(self, result):
+        items = []
+        try:
+            items = self.chunk_save(result)
+        except Exception:
+            result['error'] = traceback_format_exc()
+        return self.chunk_missing(result, items)
+
+    # answer which misses words is removed from cache, so a rerun asks again instead of replaying it
+    @staticmethod
+    def chunk_missing(result, items: list):
+        error = result['error']
+        if not error and not result['result']['success']:
+            error = f"status {result['result']['status_code']}: {result['result']['data']}"
+        found_ids = {item.get('id') for item in items if isinstance(item, dict)}
+        found_words = extra_functions.WordsIndex([item for item in items if isinstance(item, dict)])
+        missing = [word for word in result['data'] if word['id'] not in found_ids and word['word'] not in found_words]
+        if missing and result['result'] and result['result'].get('cache_key'):
+            gpt_helper.cache.delete(result['result']['cache_key'])
+        if missing and not error and result['result']['data']['finish_reason'] == 'length':
+            metrics.count('chunks_truncated')
+            error = 'answer is cut by max tokens'
+        return missing, error
+
+    # chunks are sent as workers are free, words which are not found are packed to smaller chunks and sent again
+    # (before next new chunks), so only they spend tokens again, answers are saved to journal as they come
+    def search_make(self, words: list, scheduler: RetryScheduler = None):
+        if scheduler is None:
+            scheduler = RetryScheduler(chunk_size=self.chunks_size, max_attempts=self.max_attempts)
+        scheduler.add(self.words_chunk(words))
+        results = scheduler.run(self.chunk_send, self.chunk_result_save, max_workers=self.threads_workers)
+        self.journal.close()
+        return results
+
+    async def async_search_make(self, words: list, concurrency=None, scheduler: RetryScheduler = None):
+        concurrency = concurrency or self.concurrency
+        if scheduler is None:
+            scheduler = RetryScheduler(chunk_size=self.chunks_size, max_attempts=self.max_attempts)
+        scheduler.add(self.words_chunk(words))
+        try:
+            results = await scheduler.async_run(self.async_chunk_send, self.chunk_result_save,
+                                                max_concurrency=concurrency)
+        finally:
+            await gpt_helper.async_session_close()
+        self.journal.close()
+        return results
+
+    # words of answer of one chunk (threads_run result), already parsed ones (streamed, post processed) are taken
+    @staticmethod
+    def answer_items(result):
+        if result['error'] or not result['result']['success']:
+            return []
+        if 'items' in result['result']:
+            if not result['result']['items'] and result['result'].get('parse_error'):
+                result['error'] = result['result']['parse_error']
+            return result['result']['items']
+
+        message = result['result']['data']['message']
+        try:
+            items = json_loads(message)
+        except Exception:
+            # complete words of broken answer are kept, only not finished ones are lost
+            items = array_items(message)
+            if not items:
+                result['error'] = traceback_format_exc()
+            metrics.count('gpt_answer_parse_errors')
+        return items if isinstance(items, list) else []
 
-    def search_make(self, words: list):
-        words_chunked = extra_functions.format_words_list(words, self.chunks_size)
-        gpt_requests_msg = gpt_lang.create_request_message(self.from_lang, self.to_lang, self.vocabulary_source,
-                                                           self.vocabulary_name, self.level)
-        gpt_requests = [gpt_requests_msg + str(words_list) for words_list in words_chunked]
-        return extra_functions.threads_run(gpt_helper.send_question, gpt_requests, max_workers=self.threads_workers)
+    @metrics.timed('chunk_save_seconds')
+    def chunk_save(self, result):
+        items = self.answer_items(result)
+        if items and not result['result'].get('saved'):
+            self.journal.append(sorted(items, key=lambda k: k['id']))
+        return items
 
+    @metrics.timed('search_save_seconds')
     def search_save(self, results: list):
         whole_result = []
         for result in results:
-            if not result['error'] and result['result']['success']:
-                message = result['result']['data']['message']
-                json_result = []
-                try:
-                    json_result = json_loads(message)
-                    whole_result += json_result
-                except Exception:
-                    result['error'] = traceback_format_exc()
-
-                if not result['error'] and json_result:
-                    json_result = sorted(json_result, key=lambda k: k['id'])
-                    offset_value = f"{json_result[0]['id']}_{json_result[-1]['id']}"
-                    file = extra_functions.make_offset_file(self.file_name, offset_value, self.folder)
-                    try:
-                        extra_functions.write_data_to_json_file(file, data=json_result)
-                    except Exception:
-                        file.unlink()
-                        result['error'] = traceback_format_exc()
+            try:
+                whole_result += self.chunk_save(result)
+            except Exception:
+                result['error'] = traceback_format_exc()
+        self.journal.close()
         return whole_result
 
+    # offset files are still read, so searches started before journal can be resumed
     def search_results(self):
         files = extra_functions.offsets_files_get(self.file_name, folder_path=self.folder)
         files_contents = [extra_functions.offset_file_data_get(file) for file in files]
-        return extra_functions.merge_lists(files_contents)
+        return extra_functions.merge_lists(files_contents) + self.journal.compact()
 
     def search_cleanup(self):
         files = extra_functions.offsets_files_get(self.file_name, folder_path=self.folder)
         for file in files:
             file.unlink()
+        self.journal.delete()
 
     def words_modify(self, words, max_workers=5):
-        words_chunked = extra_functions.format_words_list(words, 20)
-        gpt_requests_msg = gpt_lang.create_request_message(self.from_lang, self.to_lang, self.vocabulary_source, self.vocabulary_name, self.level)
+        words_chunked = self.words_chunk(words)
+        gpt_requests_msg = self.request_message()
         gpt_requests = [gpt_requests_msg + str(words_list) for words_list in words_chunked]
         # res = gpt_threads_run(gpt_requests, max_workers=5)
 
-        results = extra_functions.gpt_threads_run(words_chunked, max_workers=max_workers, file_name=self.file_name,
-                                                  folder_path=self.folder)
-        files = extra_functions.offsets_files_get(self.file_name, folder_path=self.folder)
-        # files = [result['file'] for result in results]
+        send_question = partial(gpt_helper.send_question, cache_check=gpt_lang.answer_check)
+        results = extra_functions.threads_run(send_question, gpt_requests, max_workers=max_workers)
+        self.search_save(results)
 
-        files_contents = [extra_functions.offset_file_data_get(file) for file in files]
-        files_contents = extra_functions.merge_lists(files_contents)
+        files_contents = self.search_results()
         missing_words = extra_functions.check_missing(new_words=words, existing_words=files_contents)
         return {'success': not missing_words,
                 'thread_results': results,
                 'modified_words': files_contents,
                 'missing_words': missing_words,
-                'files': files}
+                'files': [self.journal.file]}
 
     def words_export_to_csv(self, words: list):
         return extra_functions.save_as_csv(words, self.file_name, folder_path=self.folder)
 
     @staticmethod
-    def anki_tags_add(file, folder=''):
+    def anki_tags_make(file_line: dict):
+        tags = []
+        if file_line.get('id'):
+            tags.append(f'language_tags::language::{file_line["language"]}')
+            tags.append(f'language_tags::level::{file_line["level"]}')
+            topics_list = (file_line['topics']).split(', ')
+            tags += [f'language_tags::topics::{topic}' for topic in topics_list ]
+            tags.append(f'language_tags::type::{file_line["type"]}')
+            if 'true' in file_line.get('is_irregular', '').lower():
+                tags.append('language_tags::irregular')
+
+            source = file_line.get('source', '')
+            if not source:
+                print(file_line)
+            if ', ' in source:
+                source, sub_source = (file_line['source']).split(', ')
+                tags.append(f'language_tags::source::{source}::{sub_source}')
+            else:
+                tags.append(f'language_tags::source::{source}')
+            file_line['anki_tags'] = ' '.join(tags)
+            file_line['anki_tags_notion'] = ', '.join(tags)
+        return file_line
+
+    # return_rows=False - file is streamed row by row (constant memory) and file path is returned instead of rows
+    # post_processor - tags and csv text are made in process pool (only with return_rows=False)
+    @staticmethod
+    def anki_tags_add(file, folder='', return_rows=True, post_processor: PostProcessor = None):
         file = extra_functions.make_file_object(file, folder)
-        file_data = extra_functions.load_data_from_csv_file(file)
-        for i, file_line in enumerate(file_data):
-            tags = []
-            if file_line.get('id'):
-                tags.append(f'language_tags::language::{file_line["language"]}')
-                tags.append(f'language_tags::level::{file_line["level"]}')
-                topics_list = (file_line['topics']).split(', ')
-                tags += [f'language_tags::topics::{topic}' for topic in topics_list ]
-                tags.append(f'language_tags::type::{file_line["type"]}')
-                if 'true' in file_line.get('is_irregular', '').lower():
-                    tags.append('language_tags::irregular')
-
-                source = file_line.get('source', '')
-                if not source:
-                    print(file_line)
-                if ', ' in source:
-                    source, sub_source = (file_line['source']).split(', ')
-                    tags.append(f'language_tags::source::{source}::{sub_source}')
-                else:
-                    tags.append(f'language_tags::source::{source}')
-                file_line['anki_tags'] = ' '.join(tags)
-                file_line['anki_tags_notion'] = ', '.join(tags)
-                file_data[i] = file_line
-        extra_functions.save_as_csv(file_data, file)
+        fieldnames = extra_functions.csv_fieldnames_get(file)
+        fieldnames += [field for field in ('anki_tags', 'anki_tags_notion') if field not in fieldnames]
+        if post_processor and not return_rows:
+            parts = post_processor.csv_parts(extra_functions.iter_data_from_csv_file(file), fieldnames,
+                                             row_function=Vocabulary.anki_tags_make)
+            return extra_functions.write_csv_parts_to_file(file, fieldnames, parts)
+
+        file_data = (Vocabulary.anki_tags_make(file_line) for file_line in extra_functions.iter_data_from_csv_file(file))
+        if not return_rows:
+            return extra_functions.save_as_csv(file_data, file, fieldnames=fieldnames)
+
+        file_data = list(file_data)
+        extra_functions.save_as_csv(file_data, file, fieldnames=fieldnames)
         return file_data
 
 
+# asyncio.run can't be called inside running event loop (jupyter, async apps), coroutine should be awaited there
+def coroutine_run(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    coroutine.close()
+    raise Exception('event loop is already running, use "await vocabulary.async_add_new_words(...)" instead')
+
+
+# one leased item of work queue: chunk is sent, found words are committed as item result, not found words are put
+# back to queue as new smaller chunks (in the same transaction), item is failed (and leased again) if request failed
+def queue_item_process(work_queue: WorkQueue, item: dict, vocabularies: dict):
+    payload = item['payload']
+    params_key = str(sorted(payload['vocabulary'].items()))
+    if params_key not in vocabularies:
+        vocabularies[params_key] = Vocabulary(**payload['vocabulary'])
+    vocabulary = vocabularies[params_key]
+
+    words = payload['words']
+    try:
+        result = {'result': vocabulary.chunk_send(words, attempt=payload.get('word_attempts', 0)), 'error': None,
+                  'data': words}
+    except Exception:
+        result = {'result': None, 'error': traceback_format_exc(), 'data': words}
+    items = vocabulary.answer_items(result)
+    missing, error = vocabulary.chunk_missing(result, items)
+    if not items and error:
+        return work_queue.fail(item['id'], item['lease'], error=error)
+
+    new_items = []
+    if missing:
+        word_attempts = payload.get('word_attempts', 0) + 1
+        status = 'dead' if word_attempts >= vocabulary.max_attempts else 'ready'
+        size = max(vocabulary.chunks_size >> word_attempts, 1)
+        payloads = [dict(payload, words=missing[index: index + size], word_attempts=word_attempts)
+                    for index in range(0, len(missing), size)]
+        new_items.append((payloads, retry_priority, status, error or 'not found in answer'))
+    return work_queue.commit(item['id'], item['lease'], result=items, new_items=new_items)
+
+
+# worker of work queue, max_workers threads lease and process items until queue is drained
+# (items leased by other workers are waited for, they are leased again if their worker dies)
+# wait=True - worker keeps waiting for new items, returns count of processed items
+def queue_work(work_queue: WorkQueue, queue=None, owner=None, max_workers=5, wait=False, poll_interval=1.0):
+    processed = []
+    vocabularies = {}
+
+    def worker():
+        while True:
+            items = work_queue.lease(queue, owner=owner)
+            if not items:
+                if wait or not work_queue.is_drained(queue):
+                    sleep(poll_interval)
+                    continue
+                break
+            queue_item_process(work_queue, items[0], vocabularies)
+            processed.append(items[0]['id'])
+        work_queue.close()
+
+    threads = [Thread(target=worker) for _ in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(processed)
+
+
 def create_vocabulary(words, from_lang, to_lang, vocab_source, vocab_name, level='', folder='results', overwrite=False,
                       create_new=False):
     vocab_source = vocab_source.replace(' ', '_')
@@ -253,54 +694,39 @@ def create_vocabulary(words, from_lang, to_lang, vocab_source, vocab_name, level
     index = '' if current_index < 1 else f'.{current_index}'
     file_name = f'{file_name}{index}'
 
+    # chunks are packed by tokens and not found words are retried as in Vocabulary.add_new_words,
+    # results are kept in journal of this file (with index), so interrupted creation is resumed
+    vocabulary = Vocabulary(from_lang, to_lang, vocab_source, vocab_name, level=level, folder=folder)
+    journal = vocabulary.journal = Journal(Vocabulary.journal_file_get(folder, file_name))
     files = extra_functions.offsets_files_get(file_name, folder_path=folder)
-    if files:
-        files_contents = [extra_functions.offset_file_data_get(file) for file in files]
-        files_contents = extra_functions.merge_lists(files_contents)
+    files_contents = [extra_functions.offset_file_data_get(file) for file in files]
+    files_contents = extra_functions.merge_lists(files_contents) + journal.compact()
+    if files_contents:
         missing_words = extra_functions.check_missing(new_words=words, existing_words=files_contents)
         # words = [words[word_id] for word_id in missing_words]
         words = missing_words
 
-    words_chunked = extra_functions.format_words_list(words, 20)
-    gpt_requests_msg = gpt_lang.create_request_message(from_lang, to_lang, vocab_source, vocab_name, level)
-    gpt_requests = [gpt_requests_msg + str(words_list) for words_list in words_chunked]
-    # res = gpt_threads_run(gpt_requests, max_workers=5)
-
-    results = extra_functions.threads_run(gpt_helper.send_question, gpt_requests, max_workers=5)
-    for result in results:
-        if not result['error'] and result['result']['success']:
-            message = result['result']['data']['message']
-            try:
-                json_result = json_loads(message)
-            except Exception:
-                result['error'] = traceback_format_exc()
-
-            if not result['error']:
-                json_result = sorted(json_result, key=lambda k: k['id'])
-                offset_value = f"{json_result[0]['id']}_{json_result[-1]['id']}"
-                file = extra_functions.make_offset_file(file_name, offset_value, folder)
-                try:
-                    extra_functions.write_data_to_json_file(file, data=json_result)
-                except Exception:
-                    file.unlink()
-                    raise Exception(traceback_format_exc())
+    scheduler = RetryScheduler(chunk_size=vocabulary.chunks_size, max_attempts=vocabulary.max_attempts)
+    results = vocabulary.search_make(words, scheduler=scheduler)
 
     files = extra_functions.offsets_files_get(file_name, folder_path=folder)
     #files = [result['file'] for result in results]
 
     files_contents = [extra_functions.offset_file_data_get(file) for file in files]
-    files_contents = extra_functions.merge_lists(files_contents)
+    files_contents = extra_functions.merge_lists(files_contents) + journal.compact()
     missing_words = extra_functions.check_missing(new_words=words, existing_words=files_contents)
     file = None
     if not missing_words:
-        res = [file.unlink() for file in files]
         file = extra_functions.save_as_csv(files_contents, file_name, folder_path=folder)
+        res = [file.unlink() for file in files]
+        journal.delete()
 
     return {
                 'success': not missing_words,
                 'thread_results': results,
                 'modified_words': files_contents,
                 'missing_words': missing_words,
+                'dead_letters': scheduler.dead_letters,
                 'file': file
            }
 
@@ -0,0 +1,192 @@
+import sqlite3
+from json import dumps as json_dumps
+from json import loads as json_loads
+from time import time
+from uuid import uuid4
+from threading import local
+from pathlib import Path
+from retry_scheduler import new_priority
+
+statuses = ('ready', 'leased', 'done', 'dead')
+
+
+class WorkQueue:
+    """
+    durable queue of work items in sqlite file, shared by threads, processes and machines (file on shared volume)
+        put() - items (json payloads) are added to named queue
+        lease() - item is given to one worker for visibility_timeout seconds, if worker does not commit it in time
+                  (crashed, killed), item is given to next worker, after max_attempts leases it is dead
+        commit() - saves result, idempotent: result of the first commit is kept, later commits return False
+        fail() - item goes back to queue (or to dead after max_attempts)
+    wal=False - rollback journal instead of WAL, needed for network file systems (WAL needs shared memory)
+    """
+    def __init__(self, file='work_queue.sqlite', visibility_timeout=300, max_attempts=3, wal=True):
+        self.file = Path(file)
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.wal = wal
+        self.local = local()
+        self.connection_get().executescript('''
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 1,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'ready',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease TEXT,
+                owner TEXT,
+                lease_until REAL,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS items_lease ON items (queue, status, priority, id);
+        ''')
+
+    # one connection per thread, sqlite connections can't be shared by threads
+    def connection_get(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.file), timeout=60, isolation_level=None)
+            connection.execute(f"PRAGMA journal_mode={'WAL' if self.wal else 'DELETE'}")
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    # BEGIN IMMEDIATE takes write lock at start, so two workers can't lease the same item
+    def transaction(self, statements):
+        connection = self.connection_get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = statements(connection)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return result
+
+    @staticmethod
+    def insert(connection, queue, payloads: list, priority=new_priority, status='ready', error=None, result=None):
+        now = time()
+        result = json_dumps(result, ensure_ascii=False) if result is not None else None
+        rows = [(queue, priority, json_dumps(payload, ensure_ascii=False), status, error, result, now, now)
+                for payload in payloads]
+        connection.executemany(
+            'INSERT INTO items (queue, priority, payload, status, error, result, created, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    # status="dead" - items are only kept to be reported (f.e. words which were not found)
+    # status="done" with result - work which was done without queue (f.e. words taken from lexicon)
+    def put(self, queue, payloads: list, priority=new_priority, status='ready', error=None, result=None):
+        return self.transaction(lambda connection: self.insert(connection, queue, payloads, priority=priority,
+                                                                status=status, error=error, result=result))
+
+    # queue=None - items of any queue, expired leases are taken back (item of crashed worker)
+    def lease(self, queue=None, owner=None, count=1, timeout=None):
+        timeout = timeout or self.visibility_timeout
+        owner = owner or f'{uuid4()}'
+
+        def statements(connection):
+            now = time()
+            queue_filter, params = ('AND queue = ?', [queue]) if queue is not None else ('', [])
+            connection.execute(f'''UPDATE items SET status = 'dead', error = 'lease expired', updated = ?
+                                   WHERE status = 'leased' AND lease_until < ? AND attempts >= ? {queue_filter}''',
+                               [now, now, self.max_attempts] + params)
+            rows = connection.execute(f'''SELECT id, queue, payload, attempts FROM items
+                                          WHERE (status = 'ready' OR (status = 'leased' AND lease_until < ?))
+                                          {queue_filter} ORDER BY priority, id LIMIT ?''',
+                                      [now] + params + [count]).fetchall()
+            items = []
+            for item_id, item_queue, payload, attempts in rows:
+                lease = f'{uuid4()}'
+                connection.execute('''UPDATE items SET status = 'leased', lease = ?, owner = ?, lease_until = ?,
+                                      attempts = attempts + 1, updated = ? WHERE id = ?''',
+                                   (lease, owner, now + timeout, now, item_id))
+                items.append({'id': item_id, 'queue': item_queue, 'payload': json_loads(payload),
+                              'attempts': attempts + 1, 'lease': lease})
+            return items
+
+        return self.transaction(statements)
+
+    # keeps lease of long work, returns False if lease is lost (expired and taken by other worker)
+    def extend(self, item_id, lease, timeout=None):
+        timeout = timeout or self.visibility_timeout
+        cursor = self.connection_get().execute(
+            "UPDATE items SET lease_until = ?, updated = ? WHERE id = ? AND lease = ? AND status = 'leased'",
+            (time() + timeout, time(), item_id, lease))
+        return cursor.rowcount == 1
+
+    # result is saved even if lease is expired, unless other worker has already committed the item
+    # new_items - (payloads, priority, status, error) added to the same queue in the same transaction
+    #             (f.e. retry of part of work), only if commit is not a repeated one
+    def commit(self, item_id, lease, result=None, new_items=None):
+        def statements(connection):
+            cursor = connection.execute(
+                "UPDATE items SET status = 'done', result = ?, lease = ?, updated = ? WHERE id = ? AND status != 'done'",
+                (json_dumps(result, ensure_ascii=False), lease, time(), item_id))
+            if cursor.rowcount != 1:
+                return False
+
+            queue = connection.execute('SELECT queue FROM items WHERE id = ?', (item_id,)).fetchone()[0]
+            for payloads, priority, status, error in new_items or []:
+                self.insert(connection, queue, payloads, priority=priority, status=status, error=error)
+            return True
+
+        return self.transaction(statements)
+
+    def fail(self, item_id, lease, error=None):
+        cursor = self.connection_get().execute(
+            '''UPDATE items SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'ready' END,
+               error = ?, lease_until = NULL, updated = ? WHERE id = ? AND lease = ? AND status = 'leased' ''',
+            (self.max_attempts, str(error) if error else None, time(), item_id, lease))
+        return cursor.rowcount == 1
+
+    def stats(self, queue=None):
+        queue_filter, params = ('WHERE queue = ?', [queue]) if queue is not None else ('', [])
+        rows = self.connection_get().execute(f'SELECT status, COUNT(*) FROM items {queue_filter} GROUP BY status',
+                                             params).fetchall()
+        counts = {status: 0 for status in statuses}
+        counts.update(dict(rows))
+        return counts
+
+    # no items to lease or in work
+    def is_drained(self, queue=None):
+        counts = self.stats(queue)
+        return not counts['ready'] and not counts['leased']
+
+    def items_get(self, queue, status='done'):
+        rows = self.connection_get().execute(
+            'SELECT id, payload, result, error, attempts FROM items WHERE queue = ? AND status = ? ORDER BY id',
+            (queue, status))
+        for item_id, payload, result, error, attempts in rows:
+            yield {'id': item_id, 'payload': json_loads(payload), 'result': json_loads(result) if result else None,
+                   'error': error, 'attempts': attempts}
+
+    def delete(self, queue):
+        self.transaction(lambda connection: connection.execute('DELETE FROM items WHERE queue = ?', (queue,)))
+
+
+if __name__ == '__main__':
+    # worker process: python work_queue.py work_queue.sqlite --queue <queue> --workers 5
+    from argparse import ArgumentParser
+    import words_formatter
+
+    parser = ArgumentParser(description='worker of vocabulary builds queued by Vocabulary.queue_fill()')
+    parser.add_argument('file', help='sqlite file of queue')
+    parser.add_argument('--queue', default=None, help='queue name (file name of vocabulary), all queues if not set')
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--wait', action='store_true', help='wait for new items when queue is empty')
+    args = parser.parse_args()
+    processed = words_formatter.queue_work(WorkQueue(args.file), queue=args.queue, max_workers=args.workers,
+                                           wait=args.wait)
+    print(f'processed items: {processed}')